@@ -6,18 +6,36 @@
 - レコード単位ロック機能
 """
 
+import atexit
 import csv
+import hashlib
+import heapq
+import hmac
 import io
-import json
 import os
 import re
-from datetime import date, datetime, timedelta
-from functools import wraps
-
+import tempfile
+import threading
+import time
+import uuid
+from collections import Counter
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta, timezone
+from functools import lru_cache, wraps
+from itertools import groupby
+from types import MappingProxyType
+
+import orjson
 import psycopg2
-from psycopg2.extras import RealDictCursor
-from flask import Flask, Response, jsonify, request, send_from_directory, session
+import psycopg2.extensions
+import psycopg2.pool
+from psycopg2.extras import RealDictCursor, execute_values
+from flask import Flask, Response, g, has_app_context, jsonify, request, send_from_directory, session
+from flask.json.provider import DefaultJSONProvider
+from flask.sessions import SecureCookieSessionInterface
+from flask_compress import Compress
 from flask_cors import CORS
+from werkzeug.exceptions import NotFound
 
 
 # ------------------------------------------------------------
@@ -27,6 +45,15 @@ BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 CONFIG_PATH = os.path.join(BASE_DIR, "config.env")
 
 LOCK_DURATION_MINUTES = 2
+LOCK_CLEANUP_INTERVAL_SECONDS = 60
+VERSION_CONFLICT_MESSAGE = "他のユーザーが先に更新しています。再読み込みしてから編集してください"
+SETTINGS_CACHE_TTL_SECONDS = 30
+# ほとんど変更されない設定は長めにキャッシュする（保存時はすぐ入れ替わる）
+SETTINGS_CACHE_TTL_OVERRIDES = {"masters": 60, "status_colors": 60, "customer_masters": 60}
+LOCKS_CACHE_TTL_SECONDS = 5
+CUSTOMER_YEARS_CACHE_TTL_SECONDS = 300
+STATIC_MAX_AGE_SECONDS = 86400
+EXCLUSION_SETTING_KEYS = ("exclusion_rule_definitions", "no_contact_rules", "duplicate_check_rules")
 DEFAULT_GOAL = {"storeTarget": 0, "staffTargets": {}, "includeStaff": []}
 STAFF_ORDER = ["小俣", "平石", "北口", "尾野", "泉"]
 CLOSED_STATUSES = ("成約", "中止", "買取", "他決")
@@ -40,23 +67,22 @@ def current_month_key():
 # ------------------------------------------------------------
 # 設定読み込み
 # ------------------------------------------------------------
+_CONFIG_LINE_RE = re.compile(r"^[ \t]*([^#=\s][^=\n]*)=([^\n]*)$", re.M)
+
+
 def load_config():
-    config = {}
     # 環境変数から読み込み（Render用）
-    for key in os.environ:
-        config[key] = os.environ[key]
+    config = dict(os.environ)
 
     # config.envがあれば読み込み（ローカル開発用）
-    if os.path.exists(CONFIG_PATH):
+    try:
         with open(CONFIG_PATH, "r", encoding="utf-8") as f:
-            for line in f:
-                line = line.strip()
-                if not line or line.startswith("#") or "=" not in line:
-                    continue
-                key, value = line.split("=", 1)
-                # 環境変数が設定されていない場合のみ上書き
-                if key.strip() not in config:
-                    config[key.strip()] = value.strip()
+            text = f.read()
+    except FileNotFoundError:
+        return config
+    for key, value in _CONFIG_LINE_RE.findall(text):
+        # 環境変数が設定されていない場合のみ上書き
+        config.setdefault(key.strip(), value.strip())
     return config
 
 
@@ -64,6 +90,13 @@ CONFIG = load_config()
 
 # データベース接続文字列
 DATABASE_URL = CONFIG.get("DATABASE_URL")
+DB_POOL_MIN = int(CONFIG.get("DB_POOL_MIN", 2))
+DB_POOL_MAX = int(CONFIG.get("DB_POOL_MAX", 10))
+
+
+def password_digest(password):
+    """パスワードの比較用ダイジェスト（長さを揃えて定数時間で比較するため）"""
+    return hashlib.sha256(password.encode("utf-8")).digest()
 
 
 def get_users():
@@ -75,56 +108,161 @@ def get_users():
             if len(parts) == 3:
                 login_id, password, display_name = parts
                 users[login_id] = {
-                    "password": password,
+                    "password_digest": password_digest(password),
                     "display_name": display_name,
                     "is_admin": key == "ADMIN_USER"
                 }
     return users
 
 
-USERS = get_users()
+# ログイン時は USERS.get(login_id) の1回の参照で済む（起動後は変更しない）
+USERS = MappingProxyType(get_users())
+# /api/users の一覧も起動時に1回だけ作る（共有するので書き換えないこと）
+USERS_LIST = [
+    {"login_id": login_id, "display_name": info["display_name"], "is_admin": info.get("is_admin", False)}
+    for login_id, info in USERS.items()
+]
 
 
 # ------------------------------------------------------------
 # データベース接続
 # ------------------------------------------------------------
+_db_pool = None
+_db_pool_lock = threading.Lock()
+
+# DATE 列は date に変換せず、サーバーが返す ISO 形式の文字列（YYYY-MM-DD）のまま受け取る。
+# API はどのみち文字列で返すため、行ごとの変換と isoformat() を省ける（DateStyle は既定の ISO 前提）。
+DATE_AS_TEXT = psycopg2.extensions.new_type((1082,), "DATE_AS_TEXT", lambda value, cur: value)
+psycopg2.extensions.register_type(DATE_AS_TEXT)
+
+
+def get_db_pool():
+    """コネクションプールを取得（初回呼び出し時に作成）"""
+    global _db_pool
+    if _db_pool is None:
+        if not DATABASE_URL:
+            raise RuntimeError("DATABASE_URL is not set")
+        with _db_pool_lock:
+            if _db_pool is None:
+                _db_pool = psycopg2.pool.ThreadedConnectionPool(
+                    DB_POOL_MIN,
+                    DB_POOL_MAX,
+                    dsn=DATABASE_URL,
+                    cursor_factory=RealDictCursor,
+                )
+                atexit.register(close_db_pool)
+    return _db_pool
+
+
+def close_db_pool():
+    """プールの接続をすべて閉じる（プロセス終了時）"""
+    global _db_pool
+    with _db_pool_lock:
+        if _db_pool is not None and not _db_pool.closed:
+            _db_pool.closeall()
+        _db_pool = None
+
+
+@contextmanager
 def get_db_connection():
-    """データベース接続を取得"""
-    if not DATABASE_URL:
-        raise RuntimeError("DATABASE_URL is not set")
-    conn = psycopg2.connect(DATABASE_URL, cursor_factory=RealDictCursor)
-    return conn
+    """プールからデータベース接続を借りる
+
+    正常終了時はコミット、例外時はロールバックしてからプールへ返却する。
+    切断された接続はプールに戻さず破棄する。
+    """
+    pool = get_db_pool()
+    conn = pool.getconn()
+    discard = False
+    try:
+        yield conn
+        if not conn.closed:
+            conn.commit()
+    except Exception as exc:
+        discard = isinstance(exc, (psycopg2.OperationalError, psycopg2.InterfaceError))
+        if not conn.closed and not discard:
+            conn.rollback()
+        raise
+    finally:
+        pool.putconn(conn, close=discard or bool(conn.closed))
 
 
 # ------------------------------------------------------------
 # Flask アプリ
 # ------------------------------------------------------------
+class OrjsonProvider(DefaultJSONProvider):
+    """jsonify / request.get_json を orjson で処理する"""
+
+    # 画面側はキー順に依存しないので、並べ替えずに dict の順のまま出力する
+    sort_keys = False
+
+    def dumps(self, obj, **kwargs):
+        option = orjson.OPT_NON_STR_KEYS
+        if kwargs.get("sort_keys", self.sort_keys):
+            option |= orjson.OPT_SORT_KEYS
+        return orjson.dumps(obj, default=self.default, option=option).decode("utf-8")
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+
+class OrjsonSessionSerializer:
+    """セッション Cookie の中身を orjson で読み書きする
+
+    セッションには文字列・真偽値しか入れないので、Flask 標準のタグ付き JSON は不要。
+    タグの付かない値だけなら既存の Cookie もそのまま読める。
+    """
+
+    def dumps(self, value):
+        return orjson.dumps(value).decode("utf-8")
+
+    def loads(self, value):
+        return orjson.loads(value)
+
+
+class OrjsonSessionInterface(SecureCookieSessionInterface):
+    serializer = OrjsonSessionSerializer()
+
+
+SECRET_KEY = CONFIG.get("SECRET_KEY", "default-secret-key")
+SESSION_LIFETIME = timedelta(hours=8)
+
 app = Flask(__name__, static_folder="static")
-app.permanent_session_lifetime = timedelta(hours=8)
-app.secret_key = CONFIG.get("SECRET_KEY", "default-secret-key")
+app.json = OrjsonProvider(app)
+app.session_interface = OrjsonSessionInterface()
+app.permanent_session_lifetime = SESSION_LIFETIME
+app.secret_key = SECRET_KEY
+# 2KB 以上の JSON / HTML / JS は brotli か gzip で圧縮して返す（CSV は対象外なのでストリーミングのまま）
+app.config["COMPRESS_ALGORITHM"] = ["br", "gzip"]
+app.config["COMPRESS_MIN_SIZE"] = 2048
+# アイコン・画像はファイル名にハッシュが無いので、1日だけブラウザにキャッシュさせる
+# （index.html / JS / CSS / manifest は set_no_store_headers で毎回取り直す）
+app.config["SEND_FILE_MAX_AGE_DEFAULT"] = STATIC_MAX_AGE_SECONDS
 CORS(app, supports_credentials=True)
+Compress(app)
 
 
 # ------------------------------------------------------------
 # 共通ユーティリティ
 # ------------------------------------------------------------
+_ISO_DATE_RE = re.compile(r"([0-9]{4})-([0-9]{2})-([0-9]{2})")
+_MONTH_KEY_RE = re.compile(r"^\d{4}-\d{2}$")
+_YEAR_KEY_RE = re.compile(r"^\d{4}$")
+
+
 def parse_date(date_str):
     """日付文字列をdateオブジェクトに変換"""
-    if not date_str or date_str == "":
+    if not date_str:
         return None
+    # ゼロ埋めされた YYYY-MM-DD は strptime を通さずに直接変換
+    match = _ISO_DATE_RE.fullmatch(date_str) if type(date_str) is str else None
     try:
+        if match:
+            return date(int(match[1]), int(match[2]), int(match[3]))
         return datetime.strptime(date_str, "%Y-%m-%d").date()
     except (ValueError, TypeError):
         return None
 
 
-def format_date(d):
-    """dateオブジェクトを文字列に変換"""
-    if d is None:
-        return ""
-    return d.isoformat()
-
-
 def format_datetime(dt):
     """datetimeオブジェクトを文字列に変換"""
     if dt is None:
@@ -132,22 +270,87 @@ def format_datetime(dt):
     return dt.isoformat()
 
 
+def dump_json(value):
+    """jsonb カラム保存用に JSON 文字列へ変換"""
+    return orjson.dumps(value, option=orjson.OPT_NON_STR_KEYS).decode("utf-8")
+
+
 # ------------------------------------------------------------
 # app_settings テーブル操作
 # ------------------------------------------------------------
+# 設定値は JSON 文字列のままキャッシュし、読み出しごとに orjson.loads で
+# 新しいオブジェクトを返す（呼び出し側が書き換えてもキャッシュは汚れない）。
+# プロセス内キャッシュは TTL 付き、リクエスト内は flask.g でメモ化する。
+_settings_cache = {}
+_SETTING_NOT_CACHED = object()
+
+
+def _settings_memo():
+    if not has_app_context():
+        return {}
+    return g.setdefault("_settings_memo", {})
+
+
+def _get_cached_setting(key):
+    memo = _settings_memo()
+    if key in memo:
+        return memo[key]
+    cached = _settings_cache.get(key)
+    if cached is not None and cached[0] > time.monotonic():
+        memo[key] = cached[1]
+        return cached[1]
+    return _SETTING_NOT_CACHED
+
+
+def _set_cached_setting(key, text):
+    ttl = SETTINGS_CACHE_TTL_OVERRIDES.get(key, SETTINGS_CACHE_TTL_SECONDS)
+    _settings_cache[key] = (time.monotonic() + ttl, text)
+    _settings_memo()[key] = text
+
+
+def load_app_setting_texts(keys):
+    """複数の設定を JSON 文字列のまま1回のクエリでまとめて読み込み（無いキーは None）"""
+    texts = {}
+    missing = []
+    for key in keys:
+        text = _get_cached_setting(key)
+        if text is _SETTING_NOT_CACHED:
+            missing.append(key)
+        else:
+            texts[key] = text
+
+    if missing:
+        with get_db_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    "SELECT key, value::text AS value FROM app_settings WHERE key = ANY(%s)",
+                    (missing,)
+                )
+                fetched = {row["key"]: row["value"] for row in cur.fetchall()}
+        for key in missing:
+            texts[key] = fetched.get(key)
+            _set_cached_setting(key, texts[key])
+    return texts
+
+
+def load_app_settings_bulk(keys):
+    """複数の設定を1回のクエリでまとめて読み込み（存在するキーのみ返す）"""
+    texts = load_app_setting_texts(keys)
+    return {key: orjson.loads(text) for key, text in texts.items() if text is not None}
+
+
 def load_app_setting(key, default=None):
     """app_settingsから設定を読み込み"""
-    with get_db_connection() as conn:
-        with conn.cursor() as cur:
-            cur.execute("SELECT value FROM app_settings WHERE key = %s", (key,))
-            row = cur.fetchone()
-            if row is None:
-                return default if default is not None else {}
-            return row["value"]
+    settings = load_app_settings_bulk((key,))
+    if key not in settings:
+        return default if default is not None else {}
+    return settings[key]
 
 
 def save_app_setting(key, data):
     """app_settingsに設定を保存"""
+    text = dump_json(data)
+    _settings_cache.pop(key, None)
     with get_db_connection() as conn:
         with conn.cursor() as cur:
             cur.execute(
@@ -156,9 +359,48 @@ def save_app_setting(key, data):
                 VALUES (%s, %s::jsonb)
                 ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value
                 """,
-                (key, json.dumps(data, ensure_ascii=False))
+                (key, text)
             )
         conn.commit()
+    _set_cached_setting(key, text)
+
+
+_SETTING_ENTRY_UPSERT_SQL = """
+    INSERT INTO app_settings (key, value)
+    VALUES (%(key)s, %(seed)s::jsonb)
+    ON CONFLICT (key) DO UPDATE SET value = jsonb_set(
+        CASE WHEN jsonb_typeof(app_settings.value) = 'object'
+             THEN app_settings.value ELSE '{}'::jsonb END,
+        ARRAY[%(section)s::text],
+        CASE WHEN jsonb_typeof(app_settings.value -> %(section)s::text) = 'object'
+             THEN app_settings.value -> %(section)s::text ELSE '{}'::jsonb END
+            || jsonb_build_object(%(entry_key)s::text, %(value)s::jsonb)
+    )
+    RETURNING value::text AS value
+"""
+
+
+def save_app_setting_entry(key, section, entry_key, value, initial):
+    """設定の section.entry_key だけを DB 側でマージして保存
+
+    全体を読み込んで書き戻さないので、別のキーを同時に保存しても上書きし合わない。
+    行がまだ無い場合は initial に値を入れたものを挿入する。
+    """
+    seed = dict(initial)
+    seed[section] = {**(seed.get(section) or {}), entry_key: value}
+    _settings_cache.pop(key, None)
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(_SETTING_ENTRY_UPSERT_SQL, {
+                "key": key,
+                "seed": dump_json(seed),
+                "section": section,
+                "entry_key": entry_key,
+                "value": dump_json(value),
+            })
+            text = cur.fetchone()["value"]
+        conn.commit()
+    _set_cached_setting(key, text)
 
 
 def load_masters():
@@ -198,60 +440,52 @@ def save_status_colors(data):
     save_app_setting("status_colors", data)
 
 
+def _initial_goals_data():
+    return {"default": DEFAULT_GOAL, "monthly": {current_month_key(): DEFAULT_GOAL}, "annual": {}}
+
+
 def load_goals_data():
-    data = load_app_setting("goals", {
-        "default": DEFAULT_GOAL,
-        "monthly": {current_month_key(): DEFAULT_GOAL},
-        "annual": {}
-    })
+    data = load_app_setting("goals", _initial_goals_data())
     if not isinstance(data, dict):
         data = {}
 
     monthly = data.get("monthly")
     if monthly is None:
+        # 旧形式（目標1件のみ）を default と今月分に移行して保存
         legacy_goal = normalize_goal(data)
-        month_key = current_month_key()
-        data = {"default": legacy_goal, "monthly": {month_key: legacy_goal}, "annual": {}}
+        data = {"default": legacy_goal, "monthly": {current_month_key(): legacy_goal}, "annual": {}}
         save_app_setting("goals", data)
-        monthly = data["monthly"]
-
-    normalized_monthly = {}
-    if isinstance(monthly, dict):
-        for key, goal in monthly.items():
-            normalized_monthly[key] = normalize_goal(goal)
+        return data
 
-    default_goal = normalize_goal(data.get("default") or DEFAULT_GOAL)
     annual = data.get("annual") or {}
-    normalized_annual = {}
-    if isinstance(annual, dict):
-        for key, goal in annual.items():
-            normalized_annual[str(key)] = normalize_goal(goal)
-
-    return {"default": default_goal, "monthly": normalized_monthly, "annual": normalized_annual}
+    return {
+        "default": normalize_goal(data.get("default") or DEFAULT_GOAL),
+        "monthly": {key: normalize_goal(goal) for key, goal in monthly.items()} if isinstance(monthly, dict) else {},
+        "annual": {str(key): normalize_goal(goal) for key, goal in annual.items()} if isinstance(annual, dict) else {},
+    }
 
 
 def save_goals_data(data):
     save_app_setting("goals", data)
 
 
-def load_sales_data():
-    data = load_app_setting("sales", {
+def _initial_sales_data():
+    return {
         "default": {"store": 0, "staff": {}},
         "monthly": {current_month_key(): {"store": 0, "staff": {}}},
         "annual": {}
-    })
+    }
+
+
+def load_sales_data():
+    data = load_app_setting("sales", _initial_sales_data())
     if not isinstance(data, dict):
         data = {}
-    monthly = data.get("monthly") or {}
-    annual = data.get("annual") or {}
-    default = normalize_sales(data.get("default"))
-    normalized_monthly = {}
-    for key, rec in monthly.items():
-        normalized_monthly[key] = normalize_sales(rec)
-    normalized_annual = {}
-    for key, rec in annual.items():
-        normalized_annual[str(key)] = normalize_sales(rec)
-    return {"default": default, "monthly": normalized_monthly, "annual": normalized_annual}
+    return {
+        "default": normalize_sales(data.get("default")),
+        "monthly": {key: normalize_sales(rec) for key, rec in (data.get("monthly") or {}).items()},
+        "annual": {str(key): normalize_sales(rec) for key, rec in (data.get("annual") or {}).items()},
+    }
 
 
 def save_sales_data(data):
@@ -321,31 +555,54 @@ def save_staff_monthly_goals(data):
 # ------------------------------------------------------------
 # 目標・売上ユーティリティ
 # ------------------------------------------------------------
-def normalize_goal(goal):
-    normalized = {"storeTarget": 0, "staffTargets": {}, "includeStaff": []}
-    if isinstance(goal, dict):
-        normalized.update(goal)
-
+def _non_negative_int(value):
+    """0以上の整数に変換（変換できなければ None）"""
+    if type(value) is int:
+        return value if value > 0 else 0
+    if type(value) is str and value.isdecimal():
+        return int(value)
     try:
-        normalized["storeTarget"] = max(0, int(normalized.get("storeTarget") or 0))
+        number = int(value)
     except (TypeError, ValueError):
-        normalized["storeTarget"] = 0
+        return None
+    return number if number > 0 else 0
 
-    staff_targets = {}
-    for name, target in (normalized.get("staffTargets") or {}).items():
+
+def _non_negative_float(value):
+    """0以上の数値に変換（変換できなければ None）"""
+    if type(value) is float or type(value) is int:
+        number = float(value)
+    else:
         try:
-            staff_targets[name] = max(0, int(target))
+            number = float(value)
         except (TypeError, ValueError):
-            continue
-    normalized["staffTargets"] = staff_targets
+            return None
+    return number if number > 0 else 0
+
 
-    include_staff = []
-    for name in normalized.get("includeStaff") or []:
-        if isinstance(name, str) and name.strip():
-            include_staff.append(name.strip())
-    normalized["includeStaff"] = include_staff
+def normalize_goal(goal):
+    if not isinstance(goal, dict):
+        goal = {}
+
+    staff_targets = {}
+    for name, target in (goal.get("staffTargets") or {}).items():
+        target = _non_negative_int(target)
+        if target is not None:
+            staff_targets[name] = target
+
+    include_staff = [
+        stripped for name in goal.get("includeStaff") or []
+        if isinstance(name, str) and (stripped := name.strip())
+    ]
 
-    return normalized
+    # 既定キーを先頭に、その他のキー（繰越設定など）はそのまま残す
+    return {
+        **DEFAULT_GOAL,
+        **goal,
+        "storeTarget": _non_negative_int(goal.get("storeTarget") or 0) or 0,
+        "staffTargets": staff_targets,
+        "includeStaff": include_staff,
+    }
 
 
 def get_goal_for_month(month_key, goals_data=None):
@@ -354,11 +611,10 @@ def get_goal_for_month(month_key, goals_data=None):
 
 
 def save_goal_for_month(month_key, goal_body):
-    goals = load_goals_data()
-    goals.setdefault("monthly", {})
-    goals["monthly"][month_key] = normalize_goal(goal_body)
-    save_goals_data(goals)
-    return goals
+    # 旧形式（目標1件のみ）の行は先に読み込みで移行しておく（移行済みならキャッシュを読むだけ）
+    load_goals_data()
+    save_app_setting_entry("goals", "monthly", month_key, normalize_goal(goal_body), _initial_goals_data())
+    return load_goals_data()
 
 
 def get_goal_for_year(year_key, goals_data=None, fallback_to_default=True):
@@ -372,13 +628,12 @@ def get_goal_for_year(year_key, goals_data=None, fallback_to_default=True):
 
 
 def save_goal_for_year(year_key, goal_body):
-    goals = load_goals_data()
-    goals.setdefault("annual", {})
     normalized = normalize_goal(goal_body)
     normalized["storeTarget"] = sum(normalized.get("staffTargets", {}).values())
-    goals["annual"][str(year_key)] = normalized
-    save_goals_data(goals)
-    return goals
+    # 旧形式の行は先に移行しておく（save_goal_for_month と同じ）
+    load_goals_data()
+    save_app_setting_entry("goals", "annual", str(year_key), normalized, _initial_goals_data())
+    return load_goals_data()
 
 
 def normalize_sales(rec):
@@ -388,18 +643,14 @@ def normalize_sales(rec):
     staff = {}
     for name, val in (rec.get("staff") or {}).items():
         if isinstance(val, dict):
-            entry = {}
-            for cat in ("new", "purchase", "cancel"):
-                try:
-                    entry[cat] = max(0, float(val.get(cat, 0) or 0))
-                except (TypeError, ValueError):
-                    entry[cat] = 0
-            staff[name] = entry
+            staff[name] = {
+                cat: _non_negative_float(val.get(cat, 0) or 0) or 0
+                for cat in ("new", "purchase", "cancel")
+            }
         else:
-            try:
-                staff[name] = {"new": max(0, float(val)), "purchase": 0, "cancel": 0}
-            except (TypeError, ValueError):
-                continue
+            amount = _non_negative_float(val)
+            if amount is not None:
+                staff[name] = {"new": amount, "purchase": 0, "cancel": 0}
     cleaned["staff"] = staff
     total = sum(
         s.get("new", 0) + s.get("purchase", 0) - s.get("cancel", 0)
@@ -415,11 +666,8 @@ def get_sales_for_month(month_key, sales_data=None):
 
 
 def save_sales_for_month(month_key, body):
-    sales = load_sales_data()
-    sales.setdefault("monthly", {})
-    sales["monthly"][month_key] = normalize_sales(body)
-    save_sales_data(sales)
-    return sales
+    save_app_setting_entry("sales", "monthly", month_key, normalize_sales(body), _initial_sales_data())
+    return load_sales_data()
 
 
 def get_sales_for_year(year_key, sales_data=None, fallback_to_default=True):
@@ -433,11 +681,8 @@ def get_sales_for_year(year_key, sales_data=None, fallback_to_default=True):
 
 
 def save_sales_for_year(year_key, body):
-    sales = load_sales_data()
-    sales.setdefault("annual", {})
-    sales["annual"][str(year_key)] = normalize_sales(body)
-    save_sales_data(sales)
-    return sales
+    save_app_setting_entry("sales", "annual", str(year_key), normalize_sales(body), _initial_sales_data())
+    return load_sales_data()
 
 
 def normalize_month_key(month_key):
@@ -445,17 +690,14 @@ def normalize_month_key(month_key):
         return current_month_key()
     if not isinstance(month_key, str):
         return None
-    if re.match(r"^\d{4}-\d{2}$", month_key):
+    if _MONTH_KEY_RE.match(month_key):
         return month_key
     return None
 
 
 def month_key_from_date(date_str):
-    if not date_str:
-        return None
-    try:
-        dt = datetime.strptime(date_str, "%Y-%m-%d")
-    except (TypeError, ValueError):
+    dt = parse_date(date_str)
+    if dt is None:
         return None
     return f"{dt.year:04d}-{dt.month:02d}"
 
@@ -463,49 +705,134 @@ def month_key_from_date(date_str):
 # ------------------------------------------------------------
 # contracts テーブル操作
 # ------------------------------------------------------------
+CONTRACT_COLUMNS = (
+    "id", "source_file", "key_box_number", "status_date",
+    "reins_change_date", "reins_changed", "reins_expire_date", "reins_registered",
+    "cancel_reason", "created_at", "price_history", "notes",
+    "media_source", "deal_status", "seller_name", "seller_address",
+    "seller_contact", "change_history", "mediation_expire_date", "deal_info",
+    "staff_id", "mediation_start_date", "updated_at", "updated_by",
+    "property_address", "property_type", "current_price", "occupancy_status",
+    "application_date", "contract_type", "purchase_info", "key_location",
+)
+# 集計用（履歴・成約情報などの大きな jsonb を含まない）
+CONTRACT_SLIM_COLUMNS = (
+    "id", "staff_id", "contract_type", "deal_status",
+    "status_date", "mediation_start_date", "cancel_reason",
+)
+# NULL を '' / false にする処理は SELECT 側の COALESCE で行う（日付は ISO 形式の文字列）
+CONTRACT_TEXT_COLUMNS = frozenset((
+    "source_file", "key_box_number", "status_date", "reins_change_date",
+    "reins_expire_date", "notes", "media_source", "deal_status",
+    "seller_name", "seller_address", "seller_contact", "mediation_expire_date",
+    "staff_id", "mediation_start_date", "updated_by", "property_address",
+    "property_type", "occupancy_status", "application_date", "contract_type",
+    "key_location",
+))
+CONTRACT_BOOL_COLUMNS = frozenset(("reins_changed", "reins_registered"))
+
+
+def select_list(columns, text_columns=frozenset(), bool_columns=frozenset()):
+    """SELECT 句の列リストを作る（text_columns は ''、bool_columns は false で NULL を埋める）
+
+    別名は元の列名と同じなので、ORDER BY では「テーブル名.列名」で元の値を指定すること。
+    """
+    exprs = []
+    for col in columns:
+        if col in text_columns:
+            exprs.append(f"COALESCE({col}::text, '') AS {col}")
+        elif col in bool_columns:
+            exprs.append(f"COALESCE({col}, false) AS {col}")
+        else:
+            exprs.append(col)
+    return ", ".join(exprs)
+
+
+_CONTRACT_SELECT = (
+    f"SELECT {select_list(CONTRACT_COLUMNS, CONTRACT_TEXT_COLUMNS, CONTRACT_BOOL_COLUMNS)} FROM contracts"
+)
+_CONTRACT_SLIM_SELECT = f"SELECT {select_list(CONTRACT_SLIM_COLUMNS, CONTRACT_TEXT_COLUMNS)} FROM contracts"
+# 契約の読み込みは行ごとの dict を作らないタプルカーソルで行い、位置で取り出す
+_TupleCursor = psycopg2.extensions.cursor
+
+
 def db_row_to_contract(row):
-    """DBの行データをJSON形式の契約データに変換"""
-    status = row["deal_status"] or ""
-    deal_info = row["deal_info"]
+    """DBの行データ（CONTRACT_COLUMNS 順のタプル）をJSON形式の契約データに変換"""
+    (
+        contract_id, source_file, key_box_number, status_date,
+        reins_change_date, reins_changed, reins_expire_date, reins_registered,
+        cancel_reason, created_at, price_history, notes,
+        media_source, deal_status, seller_name, seller_address,
+        seller_contact, change_history, mediation_expire_date, deal_info,
+        staff_id, mediation_start_date, updated_at, updated_by,
+        property_address, property_type, current_price, occupancy_status,
+        application_date, contract_type, purchase_info, key_location,
+    ) = row
     return {
-        "id": row["id"],
-        "source_file": row["source_file"] or "",
-        "キーボックス番号": row["key_box_number"] or "",
-        "ステータス日付": format_date(row["status_date"]),
-        "レインズ変更日": format_date(row["reins_change_date"]),
-        "レインズ変更済み": bool(row["reins_changed"]),
-        "レインズ満了日": format_date(row["reins_expire_date"]),
-        "レインズ登録フラグ": bool(row["reins_registered"]),
-        "中止理由": json.loads(row["cancel_reason"]) if row["cancel_reason"] else None,
-        "作成日時": format_datetime(row["created_at"]),
-        "価格推移": row["price_history"] or [],
-        "備考": row["notes"] or "",
-        "反響媒体": row["media_source"] or "",
-        "取引状況": row["deal_status"] or "",
-        "売主": row["seller_name"] or "",
-        "売主住所": row["seller_address"] or "",
-        "売主連絡先": row["seller_contact"] or "",
-        "変更履歴": row["change_history"] or [],
-        "媒介期日": format_date(row["mediation_expire_date"]),
-        "成約情報": deal_info if status == "成約" else None,
-        "他決情報": deal_info if status == "他決" else None,
-        "担当": row["staff_id"] or "",
-        "新規媒介締結日": format_date(row["mediation_start_date"]),
-        "更新日時": format_datetime(row["updated_at"]),
-        "更新者": row["updated_by"] or "",
-        "物件所在地": row["property_address"] or "",
-        "物件種別": row["property_type"] or "",
-        "現在の媒介価格": row["current_price"],
-        "現況": row["occupancy_status"] or "",
-        "申込日": format_date(row["application_date"]),
-        "種別": row["contract_type"] or "",
-        "買取情報": row["purchase_info"],
-        "鍵の場所": row["key_location"] or "",
+        "id": contract_id,
+        "source_file": source_file,
+        "キーボックス番号": key_box_number,
+        "ステータス日付": status_date,
+        "レインズ変更日": reins_change_date,
+        "レインズ変更済み": reins_changed,
+        "レインズ満了日": reins_expire_date,
+        "レインズ登録フラグ": reins_registered,
+        "中止理由": orjson.loads(cancel_reason) if cancel_reason else None,
+        "作成日時": format_datetime(created_at),
+        "価格推移": price_history or [],
+        "備考": notes,
+        "反響媒体": media_source,
+        "取引状況": deal_status,
+        "売主": seller_name,
+        "売主住所": seller_address,
+        "売主連絡先": seller_contact,
+        "変更履歴": change_history or [],
+        "媒介期日": mediation_expire_date,
+        "成約情報": deal_info if deal_status == "成約" else None,
+        "他決情報": deal_info if deal_status == "他決" else None,
+        "担当": staff_id,
+        "新規媒介締結日": mediation_start_date,
+        "更新日時": format_datetime(updated_at),
+        "更新者": updated_by,
+        "物件所在地": property_address,
+        "物件種別": property_type,
+        "現在の媒介価格": current_price,
+        "現況": occupancy_status,
+        "申込日": application_date,
+        "種別": contract_type,
+        "買取情報": purchase_info,
+        "鍵の場所": key_location,
     }
 
 
+def db_row_to_contract_slim(row):
+    """集計用の列（CONTRACT_SLIM_COLUMNS 順のタプル）を契約データ形式に変換"""
+    contract_id, staff_id, contract_type, deal_status, status_date, mediation_start_date, cancel_reason = row
+    return {
+        "id": contract_id,
+        "ステータス日付": status_date,
+        "中止理由": orjson.loads(cancel_reason) if cancel_reason else None,
+        "取引状況": deal_status,
+        "担当": staff_id,
+        "新規媒介締結日": mediation_start_date,
+        "種別": contract_type,
+    }
+
+
+CONTRACT_JSON_COLUMNS = ("price_history", "change_history", "deal_info", "purchase_info")
+
+
 def contract_to_db_params(contract, year_month=None):
     """JSON形式の契約データをDBパラメータに変換"""
+    params = contract_to_db_values(contract, year_month)
+    for col in CONTRACT_JSON_COLUMNS:
+        if params[col] is not None:
+            params[col] = dump_json(params[col])
+    return params
+
+
+def contract_to_db_values(contract, year_month=None):
+    """JSON形式の契約データを列ごとの値に変換（jsonb 列はシリアライズ前のまま）"""
     current_price = contract.get("現在の媒介価格")
     if current_price is not None:
         try:
@@ -515,7 +842,7 @@ def contract_to_db_params(contract, year_month=None):
 
     cancel_reason = contract.get("中止理由")
     if isinstance(cancel_reason, dict):
-        cancel_reason = json.dumps(cancel_reason, ensure_ascii=False)
+        cancel_reason = dump_json(cancel_reason)
     deal_info = contract.get("成約情報") or contract.get("他決情報")
 
     return {
@@ -548,172 +875,397 @@ def contract_to_db_params(contract, year_month=None):
         "application_date": parse_date(contract.get("申込日")),
         "contract_type": contract.get("種別") or None,
         "key_location": contract.get("鍵の場所") or None,
-        "price_history": json.dumps(contract.get("価格推移") or [], ensure_ascii=False),
-        "change_history": json.dumps(contract.get("変更履歴") or [], ensure_ascii=False),
-        "deal_info": json.dumps(deal_info, ensure_ascii=False) if deal_info else None,
-        "purchase_info": json.dumps(contract.get("買取情報"), ensure_ascii=False) if contract.get("買取情報") else None,
+        "price_history": contract.get("価格推移") or [],
+        "change_history": contract.get("変更履歴") or [],
+        "deal_info": deal_info or None,
+        "purchase_info": contract.get("買取情報") or None,
     }
 
 
+CONTRACT_STREAM_ITERSIZE = 1000
+
+
+# 媒介No.（例: R7-1-1）を parse_contract_id_components と同じ (西暦, 月, 連番) に分解する。
+# 形式外の ID は id_key が NULL になり、ORDER BY で (9999, 99, 9999) として末尾に回る。
+_CONTRACT_ID_KEY_JOIN = """
+    LEFT JOIN LATERAL (
+        SELECT CASE WHEN m[1] <> '' THEN 2018 + m[2]::numeric
+                    WHEN m[2]::numeric < 100 THEN 2000 + m[2]::numeric
+                    ELSE m[2]::numeric END AS year,
+               m[3]::numeric AS month,
+               m[4]::numeric AS seq
+        FROM regexp_match(contracts.id, '^([Rr]?)([0-9]+)-([0-9]+)-([0-9]+)$') AS m
+        WHERE m[3]::numeric BETWEEN 1 AND 12 AND (m[1] = '' OR m[2]::numeric > 0)
+    ) AS id_key ON true
+"""
+_CONTRACT_ID_ORDER = (
+    "COALESCE(id_key.year, 9999), COALESCE(id_key.month, 99), COALESCE(id_key.seq, 9999), "
+    "contracts.property_address"
+)
+
+
+def iter_contracts_filtered(*, year_month=None, staff_id=None, deal_statuses=None,
+                            exclude_deal_statuses=None, extra_conditions=(),
+                            order_by_contract_id=False, limit=None, offset=None):
+    """条件に合う契約を順に返すジェネレーター（絞り込みと並べ替えは SQL 側で行う）
+
+    サーバーサイドカーソルで CONTRACT_STREAM_ITERSIZE 件ずつ取得するため、
+    全件を一度にメモリへ載せない。読み終えるまで接続を1本使い続ける。
+    exclude_deal_statuses は取引状況が未設定の契約を除外しない。
+    extra_conditions は (SQL の条件, パラメータのタプル) のリストで、AND で追加する。
+    既定は物件所在地順、order_by_contract_id=True で媒介No.の (年, 月, 連番) 順。
+    """
+    conditions = []
+    params = []
+    if year_month is not None:
+        conditions.append("year_month = %s")
+        params.append(year_month)
+    if staff_id is not None:
+        conditions.append("staff_id = %s")
+        params.append(staff_id)
+    if deal_statuses is not None:
+        conditions.append("deal_status = ANY(%s)")
+        params.append(list(deal_statuses))
+    if exclude_deal_statuses is not None:
+        conditions.append("(deal_status IS NULL OR deal_status <> ALL(%s))")
+        params.append(list(exclude_deal_statuses))
+    for condition, condition_params in extra_conditions:
+        conditions.append(f"({condition})")
+        params.extend(condition_params)
+
+    query = _CONTRACT_SELECT
+    if order_by_contract_id:
+        query += _CONTRACT_ID_KEY_JOIN
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    if order_by_contract_id:
+        query += f" ORDER BY {_CONTRACT_ID_ORDER}"
+    else:
+        query += " ORDER BY contracts.property_address"
+    if limit is not None:
+        query += " LIMIT %s"
+        params.append(limit)
+    if offset is not None:
+        query += " OFFSET %s"
+        params.append(offset)
+
+    with get_db_connection() as conn:
+        with conn.cursor(name="iter_contracts", cursor_factory=_TupleCursor) as cur:
+            cur.itersize = CONTRACT_STREAM_ITERSIZE
+            cur.execute(query, params)
+            for row in cur:
+                yield db_row_to_contract(row)
+
+
+def load_contracts_filtered(**filters):
+    """条件に合う契約を読み込み（引数は iter_contracts_filtered と同じ）"""
+    return list(iter_contracts_filtered(**filters))
+
+
+def iter_all_contracts():
+    """全ての契約を順に返すジェネレーター"""
+    return iter_contracts_filtered()
+
+
+# 全件読み込みの結果はリクエスト内で flask.g にメモ化する（同じリクエストで
+# 集計を組み合わせても読み直さない）。契約を書き込んだらメモを捨てる。
+# 返すリストは共有されるので、呼び出し側で書き換えないこと。
+def _contracts_memo():
+    if not has_app_context():
+        return {}
+    return g.setdefault("_contracts_memo", {})
+
+
+def invalidate_contracts_memo():
+    if has_app_context():
+        g.pop("_contracts_memo", None)
+
+
+def contracts_fingerprint():
+    """契約テーブルの版（件数と行の xmin の合計）。プロセス内の集計キャッシュや ETag の鍵にする
+
+    xmin は行を書き込んだトランザクションの番号なので、他のワーカーや
+    Supabase の画面・スクリプトからの追加・更新・削除でも必ず値が変わる。
+    """
+    memo = _contracts_memo()
+    if "fingerprint" not in memo:
+        with get_db_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    "SELECT count(*) AS rows, COALESCE(sum(xmin::text::bigint), 0)::text AS xmin_sum FROM contracts"
+                )
+                row = cur.fetchone()
+        memo["fingerprint"] = f"{row['rows']}-{row['xmin_sum']}"
+    return memo["fingerprint"]
+
+
 def load_all_contracts():
     """全ての契約を読み込み"""
+    memo = _contracts_memo()
+    if "all" not in memo:
+        memo["all"] = list(iter_all_contracts())
+    return memo["all"]
+
+
+def load_all_contracts_slim():
+    """全ての契約を集計用の列だけで読み込み"""
+    memo = _contracts_memo()
+    if "slim" not in memo:
+        with get_db_connection() as conn:
+            with conn.cursor(cursor_factory=_TupleCursor) as cur:
+                cur.execute(f"{_CONTRACT_SLIM_SELECT} ORDER BY contracts.property_address")
+                rows = cur.fetchall()
+        memo["slim"] = [db_row_to_contract_slim(row) for row in rows]
+    return memo["slim"]
+
+
+def count_open_contracts_by_staff_and_type():
+    """未終了の契約を (担当, 種別) ごとに数える
+
+    種別の表記ゆれの吸収は呼び出し側で行う。担当が最初に現れる順を保つため、
+    物件所在地の最小値順に返す。
+    """
     with get_db_connection() as conn:
-        with conn.cursor() as cur:
-            cur.execute("SELECT * FROM contracts ORDER BY property_address")
-            rows = cur.fetchall()
-    return [db_row_to_contract(row) for row in rows]
+        with conn.cursor(cursor_factory=_TupleCursor) as cur:
+            cur.execute(
+                """
+                SELECT staff_id, contract_type, COUNT(*) FROM contracts
+                WHERE deal_status IS NULL OR deal_status <> ALL(%s)
+                GROUP BY staff_id, contract_type
+                ORDER BY MIN(property_address)
+                """,
+                (list(CLOSED_STATUSES),),
+            )
+            return cur.fetchall()
 
 
 def find_contract(contract_id):
     """契約IDで契約を検索"""
     with get_db_connection() as conn:
-        with conn.cursor() as cur:
-            cur.execute("SELECT * FROM contracts WHERE id = %s", (contract_id,))
+        with conn.cursor(cursor_factory=_TupleCursor) as cur:
+            cur.execute(f"{_CONTRACT_SELECT} WHERE id = %s", (contract_id,))
             row = cur.fetchone()
             if row is None:
                 return None
             return db_row_to_contract(row)
 
 
+CONTRACT_WRITE_COLUMNS = (
+    "id", "year_month", "source_file",
+    "key_box_number", "status_date", "reins_change_date",
+    "reins_changed", "reins_expire_date", "reins_registered",
+    "cancel_reason", "created_at", "updated_at", "updated_by",
+    "notes", "media_source", "deal_status",
+    "seller_name", "seller_address", "seller_contact",
+    "mediation_expire_date", "mediation_start_date", "staff_id",
+    "property_address", "property_type", "current_price",
+    "occupancy_status", "application_date", "contract_type",
+    "key_location", "price_history", "change_history",
+    "deal_info", "purchase_info",
+)
+_CONTRACT_INSERT_SQL = f"INSERT INTO contracts ({', '.join(CONTRACT_WRITE_COLUMNS)}) VALUES %s"
+_CONTRACT_VALUES_TEMPLATE = "(" + ", ".join(f"%({col})s" for col in CONTRACT_WRITE_COLUMNS) + ")"
+_CONTRACT_UPSERT_SQL = " ON CONFLICT (id) DO UPDATE SET " + ", ".join(
+    f"{col} = EXCLUDED.{col}" for col in CONTRACT_WRITE_COLUMNS if col != "id"
+)
+_CONTRACT_INSERT_ONE_SQL = (
+    _CONTRACT_INSERT_SQL.replace("VALUES %s", "VALUES " + _CONTRACT_VALUES_TEMPLATE)
+    + " ON CONFLICT (id) DO NOTHING RETURNING true AS inserted, updated_at"
+)
+_CONTRACT_UPSERT_ONE_SQL = (
+    _CONTRACT_INSERT_SQL.replace("VALUES %s", "VALUES " + _CONTRACT_VALUES_TEMPLATE)
+    + _CONTRACT_UPSERT_SQL
+    + " RETURNING (xmax = 0) AS inserted, updated_at"
+)
+# 楽観的排他の条件（読み込み時の更新日時と文字列ではなく時刻として比較する）
+_CONTRACT_VERSION_CONDITION = " AND updated_at IS NOT DISTINCT FROM %(expected_updated_at)s::timestamptz"
+
+
+def save_contracts_bulk(contracts, year_month=None, allow_update=True):
+    """複数の契約をまとめて保存（500件ごとに1往復、コミットは1回）
+
+    各行が新規挿入だったかどうかのリストを入力順で返す。
+    同じIDを1回の呼び出しに重複して含めないこと。
+    """
+    rows = [contract_to_db_params(contract, year_month) for contract in contracts]
+    if not rows:
+        return []
+    invalidate_contracts_memo()
+    sql = (
+        _CONTRACT_INSERT_SQL
+        + (_CONTRACT_UPSERT_SQL if allow_update else "")
+        + " RETURNING (xmax = 0) AS inserted"
+    )
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            result = execute_values(
+                cur, sql, rows, template=_CONTRACT_VALUES_TEMPLATE, page_size=500, fetch=True
+            )
+        conn.commit()
+    return [row["inserted"] for row in result]
+
+
 def save_contract(contract, year_month=None, allow_update=True):
-    """Save a contract. Set allow_update=False for insert-only create paths."""
+    """契約を保存し、新しい行を挿入したときは True を返す
+
+    allow_update=False は新規作成用で、同じ媒介No.が既にあれば何もせず False を返す。
+    """
+    params = contract_to_db_params(contract, year_month)
+    invalidate_contracts_memo()
+    statement = _CONTRACT_UPSERT_ONE_SQL if allow_update else _CONTRACT_INSERT_ONE_SQL
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(statement, params)
+            row = cur.fetchone()
+        conn.commit()
+    return row is not None and row["inserted"]
+
+
+def update_contract(existing, contract, year_month=None, expected_updated_at=None, history_append=None):
+    """既存の契約から値が変わった列だけを UPDATE する
+
+    jsonb 列は変わったときだけシリアライズして送る。成約情報・他決情報は
+    読み込み時に取引状況で隠れるため、空なら毎回 NULL を書いて古い値を残さない。
+    expected_updated_at（読み込み時の更新日時、未設定は ""）を渡すと、DB 側の更新日時が
+    一致するときだけ更新し、一致しなければ None を返す（楽観的排他）。
+    渡さない場合、行が既に無ければ通常の保存（upsert）で作り直す。
+    history_append を渡すと、変更履歴は全体を書き直さず DB 側で末尾に追記する。
+    保存できたら DB 上の更新日時を find_contract と同じ形式の文字列で返す。
+    """
+    old_values = contract_to_db_values(existing, year_month)
+    changed = {
+        col: value
+        for col, value in contract_to_db_values(contract, year_month).items()
+        if col == "year_month" or value != old_values[col] or (col == "deal_info" and value is None)
+    }
+    changed.pop("id", None)
+    if history_append is not None:
+        changed.pop("change_history", None)
+    for col in CONTRACT_JSON_COLUMNS:
+        if changed.get(col) is not None:
+            changed[col] = dump_json(changed[col])
+
+    invalidate_contracts_memo()
+    assignments = [f"{col} = %({col})s" for col in changed]
+    if history_append:
+        assignments.append("change_history = COALESCE(change_history, '[]'::jsonb) || %(history_append)s::jsonb")
+        changed["history_append"] = dump_json(history_append)
+    assignments = ", ".join(assignments)
+    query = f"UPDATE contracts SET {assignments} WHERE id = %(id)s"
+    params = {**changed, "id": existing["id"]}
+    if expected_updated_at is not None:
+        query += _CONTRACT_VERSION_CONDITION
+        params["expected_updated_at"] = expected_updated_at or None
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(query + " RETURNING updated_at", params)
+            row = cur.fetchone()
+            if row is None and expected_updated_at is None:
+                cur.execute(_CONTRACT_UPSERT_ONE_SQL, contract_to_db_params(contract, year_month))
+                row = cur.fetchone()
+        conn.commit()
+    return None if row is None else format_datetime(row["updated_at"])
+
+
+def rename_contract(old_id, contract, year_month=None, expected_updated_at=None):
+    """媒介No.を変更する（古い行の削除と新しいIDでの挿入を1トランザクションで行う）
+
+    expected_updated_at を渡すと、古い行の更新日時が一致するときだけ変更する。
+    戻り値は (結果, 更新日時)。結果は "ok"、古い行が変わっていれば "conflict"、
+    新しいIDが既に使われていれば "duplicate"（後の2つは何も変更しない）。
+    """
     params = contract_to_db_params(contract, year_month)
-    conflict_sql = """
-                ON CONFLICT (id) DO UPDATE SET
-                    year_month = EXCLUDED.year_month,
-                    source_file = EXCLUDED.source_file,
-                    key_box_number = EXCLUDED.key_box_number,
-                    status_date = EXCLUDED.status_date,
-                    reins_change_date = EXCLUDED.reins_change_date,
-                    reins_changed = EXCLUDED.reins_changed,
-                    reins_expire_date = EXCLUDED.reins_expire_date,
-                    reins_registered = EXCLUDED.reins_registered,
-                    cancel_reason = EXCLUDED.cancel_reason,
-                    created_at = EXCLUDED.created_at,
-                    updated_at = EXCLUDED.updated_at,
-                    updated_by = EXCLUDED.updated_by,
-                    notes = EXCLUDED.notes,
-                    media_source = EXCLUDED.media_source,
-                    deal_status = EXCLUDED.deal_status,
-                    seller_name = EXCLUDED.seller_name,
-                    seller_address = EXCLUDED.seller_address,
-                    seller_contact = EXCLUDED.seller_contact,
-                    mediation_expire_date = EXCLUDED.mediation_expire_date,
-                    mediation_start_date = EXCLUDED.mediation_start_date,
-                    staff_id = EXCLUDED.staff_id,
-                    property_address = EXCLUDED.property_address,
-                    property_type = EXCLUDED.property_type,
-                    current_price = EXCLUDED.current_price,
-                    occupancy_status = EXCLUDED.occupancy_status,
-                    application_date = EXCLUDED.application_date,
-                    contract_type = EXCLUDED.contract_type,
-                    key_location = EXCLUDED.key_location,
-                    price_history = EXCLUDED.price_history,
-                    change_history = EXCLUDED.change_history,
-                    deal_info = EXCLUDED.deal_info,
-                    purchase_info = EXCLUDED.purchase_info
-                """ if allow_update else ""
+    invalidate_contracts_memo()
     with get_db_connection() as conn:
         with conn.cursor() as cur:
-            cur.execute(
-                f"""
-                INSERT INTO contracts (
-                    id, year_month, source_file,
-                    key_box_number, status_date, reins_change_date,
-                    reins_changed, reins_expire_date, reins_registered,
-                    cancel_reason, created_at, updated_at, updated_by,
-                    notes, media_source, deal_status,
-                    seller_name, seller_address, seller_contact,
-                    mediation_expire_date, mediation_start_date, staff_id,
-                    property_address, property_type, current_price,
-                    occupancy_status, application_date, contract_type,
-                    key_location, price_history, change_history,
-                    deal_info, purchase_info
-                ) VALUES (
-                    %(id)s, %(year_month)s, %(source_file)s,
-                    %(key_box_number)s, %(status_date)s, %(reins_change_date)s,
-                    %(reins_changed)s, %(reins_expire_date)s, %(reins_registered)s,
-                    %(cancel_reason)s, %(created_at)s, %(updated_at)s, %(updated_by)s,
-                    %(notes)s, %(media_source)s, %(deal_status)s,
-                    %(seller_name)s, %(seller_address)s, %(seller_contact)s,
-                    %(mediation_expire_date)s, %(mediation_start_date)s, %(staff_id)s,
-                    %(property_address)s, %(property_type)s, %(current_price)s,
-                    %(occupancy_status)s, %(application_date)s, %(contract_type)s,
-                    %(key_location)s, %(price_history)s, %(change_history)s,
-                    %(deal_info)s, %(purchase_info)s
-                )
-                {conflict_sql}
-                """,
-                params
-            )
+            query = "DELETE FROM contracts WHERE id = %(id)s"
+            delete_params = {"id": old_id}
+            if expected_updated_at is not None:
+                query += _CONTRACT_VERSION_CONDITION
+                delete_params["expected_updated_at"] = expected_updated_at or None
+            cur.execute(query, delete_params)
+            if expected_updated_at is not None and not cur.rowcount:
+                conn.rollback()
+                return "conflict", None
+            cur.execute(_CONTRACT_INSERT_ONE_SQL, params)
+            row = cur.fetchone()
+            if row is None:
+                conn.rollback()
+                return "duplicate", None
         conn.commit()
+    return "ok", format_datetime(row["updated_at"])
 
 
 def delete_contract(contract_id):
     """契約を削除"""
+    invalidate_contracts_memo()
     with get_db_connection() as conn:
         with conn.cursor() as cur:
             cur.execute("DELETE FROM contracts WHERE id = %s", (contract_id,))
         conn.commit()
 
 
-def duplicate_exists(contract_id, exclude_id=None):
-    """重複チェック"""
-    with get_db_connection() as conn:
-        with conn.cursor() as cur:
-            if exclude_id:
-                cur.execute(
-                    "SELECT 1 FROM contracts WHERE id = %s AND id != %s LIMIT 1",
-                    (contract_id, exclude_id)
-                )
-            else:
-                cur.execute("SELECT 1 FROM contracts WHERE id = %s LIMIT 1", (contract_id,))
-            return cur.fetchone() is not None
-
-
 # ------------------------------------------------------------
 # customers テーブル操作
 # ------------------------------------------------------------
+CUSTOMER_COLUMNS = (
+    "id", "year", "case_number", "status", "staff_id",
+    "inquiry_date", "inquiry_source", "contact_method",
+    "property_type", "target_property", "assessment_address", "desired_property",
+    "customer_name", "phone", "current_address", "email",
+    "first_call", "call_status", "mail_status", "sms_status",
+    "showing_status", "pre_assessment", "visit_status",
+    "mediation_status", "contract_status", "postal_status", "billing_exclusion", "exclusion_data",
+    "expected_yield", "expected_rent", "self_funds", "desired_loan", "preferred_area",
+    "memo", "created_at", "updated_at",
+)
+# id（uuid）も文字列で受け取る
+CUSTOMER_TEXT_COLUMNS = frozenset(
+    col for col in CUSTOMER_COLUMNS if col not in ("year", "exclusion_data", "created_at", "updated_at")
+)
+_CUSTOMER_SELECT = f"SELECT {select_list(CUSTOMER_COLUMNS, CUSTOMER_TEXT_COLUMNS)} FROM customers"
+
+
 def db_row_to_customer(row):
     """DBの行データをJSON形式の顧客データに変換"""
     return {
-        "id": str(row["id"]),
-        "case_number": row["case_number"] or "",
-        "status": row["status"] or "",
-        "staff_id": row["staff_id"] or "",
-        "inquiry_date": format_date(row["inquiry_date"]),
-        "inquiry_source": row["inquiry_source"] or "",
-        "contact_method": row["contact_method"] or "",
-        "property_type": row["property_type"] or "",
-        "target_property": row["target_property"] or "",
-        "assessment_address": row["assessment_address"] or "",
-        "desired_property": row["desired_property"] or "",
-        "customer_name": row["customer_name"] or "",
-        "phone": row["phone"] or "",
-        "current_address": row["current_address"] or "",
-        "email": row["email"] or "",
-        "first_call": row["first_call"] or "",
-        "call_status": row["call_status"] or "",
-        "mail_status": row["mail_status"] or "",
-        "sms_status": row["sms_status"] or "",
-        "showing_status": row["showing_status"] or "",
-        "pre_assessment": row["pre_assessment"] or "",
-        "visit_status": row["visit_status"] or "",
-        "mediation": row["mediation_status"] or "",
-        "contract": row["contract_status"] or "",
-        "postal_status": row.get("postal_status") or "",
-        "billing_exclusion": row.get("billing_exclusion") or "",
-        "exclusion_data": row.get("exclusion_data") or {},
-        "expected_yield": row["expected_yield"] or "",
-        "yield_rate": row["expected_yield"] or "",
-        "expected_rent": row["expected_rent"] or "",
-        "own_funds": row["self_funds"] or "",
-        "self_funds": row["self_funds"] or "",
-        "loan_amount": row["desired_loan"] or "",
-        "desired_loan": row["desired_loan"] or "",
-        "desired_area": row["preferred_area"] or "",
-        "preferred_area": row["preferred_area"] or "",
-        "memo": row["memo"] or "",
+        "id": row["id"],
+        "case_number": row["case_number"],
+        "status": row["status"],
+        "staff_id": row["staff_id"],
+        "inquiry_date": row["inquiry_date"],
+        "inquiry_source": row["inquiry_source"],
+        "contact_method": row["contact_method"],
+        "property_type": row["property_type"],
+        "target_property": row["target_property"],
+        "assessment_address": row["assessment_address"],
+        "desired_property": row["desired_property"],
+        "customer_name": row["customer_name"],
+        "phone": row["phone"],
+        "current_address": row["current_address"],
+        "email": row["email"],
+        "first_call": row["first_call"],
+        "call_status": row["call_status"],
+        "mail_status": row["mail_status"],
+        "sms_status": row["sms_status"],
+        "showing_status": row["showing_status"],
+        "pre_assessment": row["pre_assessment"],
+        "visit_status": row["visit_status"],
+        "mediation": row["mediation_status"],
+        "contract": row["contract_status"],
+        "postal_status": row["postal_status"],
+        "billing_exclusion": row["billing_exclusion"],
+        "exclusion_data": row["exclusion_data"] or {},
+        "expected_yield": row["expected_yield"],
+        "yield_rate": row["expected_yield"],
+        "expected_rent": row["expected_rent"],
+        "own_funds": row["self_funds"],
+        "self_funds": row["self_funds"],
+        "loan_amount": row["desired_loan"],
+        "desired_loan": row["desired_loan"],
+        "desired_area": row["preferred_area"],
+        "preferred_area": row["preferred_area"],
+        "memo": row["memo"],
         "year": row["year"],
         "created_at": format_datetime(row["created_at"]),
         "updated_at": format_datetime(row["updated_at"]),
@@ -725,7 +1277,7 @@ def load_customers(category, year):
     with get_db_connection() as conn:
         with conn.cursor() as cur:
             cur.execute(
-                "SELECT * FROM customers WHERE category = %s AND year = %s ORDER BY case_number DESC",
+                f"{_CUSTOMER_SELECT} WHERE category = %s AND year = %s ORDER BY customers.case_number DESC",
                 (category, year)
             )
             rows = cur.fetchall()
@@ -739,121 +1291,226 @@ def load_customers(category, year):
     }
 
 
-def save_customer(category, year, customer):
-    """顧客を保存（upsert）"""
-    customer_id = customer.get("id")
+CUSTOMER_KEYWORD_COLUMNS = (
+    "customer_name", "assessment_address", "target_property", "desired_property",
+    "current_address", "case_number", "phone",
+)
+# キーワード検索用に検索対象の列を区切り文字 (U+001F) でつないだ式。
+# supabasesql.txt の trigram インデックスと同じ式にしておくこと。
+_CUSTOMER_KEYWORD_SEPARATOR = "\x1f"
+_CUSTOMER_SEARCH_TEXT = " || E'\\x1f' || ".join(
+    f"COALESCE(customers.{col}, '')" for col in CUSTOMER_KEYWORD_COLUMNS
+)
+# 案件番号の末尾4桁（連番）の降順、同じなら案件番号の降順（末尾が数字でなければ連番0扱い）
+_CUSTOMER_CASE_ORDER = (
+    "COALESCE(substring(customers.case_number from '[0-9]{4}$')::int, 0) DESC,"
+    " COALESCE(customers.case_number, '') COLLATE \"C\" DESC"
+)
+
+
+def like_pattern(text):
+    """LIKE / ILIKE 用に部分一致パターンを作る（% _ \\ はエスケープ）"""
+    escaped = text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return f"%{escaped}%"
+
+
+def query_customers(category, year, *, staff=None, status=None, keyword=None, date_from=None, date_to=None):
+    """条件に合う顧客を案件番号の連番の降順で読み込み
+
+    keyword は CUSTOMER_KEYWORD_COLUMNS のいずれかに大文字小文字を区別せず含まれるもの。
+    date_from / date_to は反響日（未設定は空文字）との文字列比較。
+    """
+    conditions = ["category = %s", "year = %s"]
+    params = [category, year]
+    if staff:
+        conditions.append("staff_id = %s")
+        params.append(staff)
+    if status:
+        conditions.append("status = %s")
+        params.append(status)
+    if keyword and _CUSTOMER_KEYWORD_SEPARATOR not in keyword:
+        # 区切り文字を含まないキーワードは列をまたいで一致しないので、連結した1つの式で探す
+        conditions.append(f"({_CUSTOMER_SEARCH_TEXT}) ILIKE %s")
+        params.append(like_pattern(keyword))
+    elif keyword:
+        pattern = like_pattern(keyword)
+        conditions.append("(" + " OR ".join(f"customers.{col} ILIKE %s" for col in CUSTOMER_KEYWORD_COLUMNS) + ")")
+        params.extend([pattern] * len(CUSTOMER_KEYWORD_COLUMNS))
+    if date_from:
+        conditions.append("COALESCE(customers.inquiry_date::text, '') COLLATE \"C\" >= %s")
+        params.append(date_from)
+    if date_to:
+        conditions.append("COALESCE(customers.inquiry_date::text, '') COLLATE \"C\" <= %s")
+        params.append(date_to)
 
     with get_db_connection() as conn:
         with conn.cursor() as cur:
             cur.execute(
-                """
-                INSERT INTO customers (
-                    id, category, year, case_number, status, staff_id,
-                    inquiry_date, inquiry_source, contact_method,
-                    property_type, target_property, assessment_address, desired_property,
-                    customer_name, phone, current_address, email,
-                    first_call, call_status, mail_status, sms_status,
-                    showing_status, pre_assessment, visit_status,
-                    mediation_status, contract_status, postal_status, billing_exclusion, exclusion_data,
-                    expected_yield, expected_rent, self_funds, desired_loan, preferred_area,
-                    memo, created_at, updated_at
-                ) VALUES (
-                    %(id)s::uuid, %(category)s, %(year)s, %(case_number)s, %(status)s, %(staff_id)s,
-                    %(inquiry_date)s, %(inquiry_source)s, %(contact_method)s,
-                    %(property_type)s, %(target_property)s, %(assessment_address)s, %(desired_property)s,
-                    %(customer_name)s, %(phone)s, %(current_address)s, %(email)s,
-                    %(first_call)s, %(call_status)s, %(mail_status)s, %(sms_status)s,
-                    %(showing_status)s, %(pre_assessment)s, %(visit_status)s,
-                    %(mediation_status)s, %(contract_status)s, %(postal_status)s, %(billing_exclusion)s, %(exclusion_data)s,
-                    %(expected_yield)s, %(expected_rent)s, %(self_funds)s, %(desired_loan)s, %(preferred_area)s,
-                    %(memo)s, %(created_at)s, %(updated_at)s
-                )
-                ON CONFLICT (id) DO UPDATE SET
-                    category = EXCLUDED.category,
-                    year = EXCLUDED.year,
-                    case_number = EXCLUDED.case_number,
-                    status = EXCLUDED.status,
-                    staff_id = EXCLUDED.staff_id,
-                    inquiry_date = EXCLUDED.inquiry_date,
-                    inquiry_source = EXCLUDED.inquiry_source,
-                    contact_method = EXCLUDED.contact_method,
-                    property_type = EXCLUDED.property_type,
-                    target_property = EXCLUDED.target_property,
-                    assessment_address = EXCLUDED.assessment_address,
-                    desired_property = EXCLUDED.desired_property,
-                    customer_name = EXCLUDED.customer_name,
-                    phone = EXCLUDED.phone,
-                    current_address = EXCLUDED.current_address,
-                    email = EXCLUDED.email,
-                    first_call = EXCLUDED.first_call,
-                    call_status = EXCLUDED.call_status,
-                    mail_status = EXCLUDED.mail_status,
-                    sms_status = EXCLUDED.sms_status,
-                    showing_status = EXCLUDED.showing_status,
-                    pre_assessment = EXCLUDED.pre_assessment,
-                    visit_status = EXCLUDED.visit_status,
-                    mediation_status = EXCLUDED.mediation_status,
-                    contract_status = EXCLUDED.contract_status,
-                    postal_status = EXCLUDED.postal_status,
-                    billing_exclusion = EXCLUDED.billing_exclusion,
-                    exclusion_data = EXCLUDED.exclusion_data,
-                    expected_yield = EXCLUDED.expected_yield,
-                    expected_rent = EXCLUDED.expected_rent,
-                    self_funds = EXCLUDED.self_funds,
-                    desired_loan = EXCLUDED.desired_loan,
-                    preferred_area = EXCLUDED.preferred_area,
-                    memo = EXCLUDED.memo,
-                    updated_at = EXCLUDED.updated_at
-                """,
-                {
-                    "id": customer_id,
-                    "category": category,
-                    "year": year,
-                    "case_number": customer.get("case_number") or "",
-                    "status": customer.get("status") or None,
-                    "staff_id": customer.get("staff_id") or None,
-                    "inquiry_date": parse_date(customer.get("inquiry_date")),
-                    "inquiry_source": customer.get("inquiry_source") or None,
-                    "contact_method": customer.get("contact_method") or None,
-                    "property_type": customer.get("property_type") or None,
-                    "target_property": customer.get("target_property") or None,
-                    "assessment_address": customer.get("assessment_address") or None,
-                    "desired_property": customer.get("desired_property") or None,
-                    "customer_name": customer.get("customer_name") or None,
-                    "phone": customer.get("phone") or None,
-                    "current_address": customer.get("current_address") or None,
-                    "email": customer.get("email") or None,
-                    "first_call": customer.get("first_call") or None,
-                    "call_status": customer.get("call_status") or None,
-                    "mail_status": customer.get("mail_status") or None,
-                    "sms_status": customer.get("sms_status") or None,
-                    "showing_status": customer.get("showing_status") or None,
-                    "pre_assessment": customer.get("pre_assessment") or None,
-                    "visit_status": customer.get("visit_status") or None,
-                    "mediation_status": customer.get("mediation") or customer.get("mediation_status") or None,
-                    "contract_status": customer.get("contract") or customer.get("contract_status") or None,
-                    "postal_status": customer.get("postal_status") or None,
-                    "billing_exclusion": customer.get("billing_exclusion") or None,
-                    "exclusion_data": json.dumps(customer.get("exclusion_data") or {}, ensure_ascii=False),
-                    "expected_yield": customer.get("yield_rate") or customer.get("expected_yield") or None,
-                    "expected_rent": customer.get("expected_rent") or None,
-                    "self_funds": customer.get("own_funds") or customer.get("self_funds") or None,
-                    "desired_loan": customer.get("loan_amount") or customer.get("desired_loan") or None,
-                    "preferred_area": customer.get("desired_area") or customer.get("preferred_area") or None,
-                    "memo": customer.get("memo") or None,
-                    "created_at": customer.get("created_at") or datetime.now().isoformat(),
-                    "updated_at": customer.get("updated_at") or datetime.now().isoformat(),
-                }
+                f"{_CUSTOMER_SELECT} WHERE {' AND '.join(conditions)} ORDER BY {_CUSTOMER_CASE_ORDER}",
+                params
+            )
+            rows = cur.fetchall()
+    return [db_row_to_customer(row) for row in rows]
+
+
+# 顧客 JSON のキーをそのまま使う列（空値は NULL で保存）
+_CUSTOMER_PLAIN_FIELDS = (
+    "status", "staff_id", "inquiry_source", "contact_method",
+    "property_type", "target_property", "assessment_address", "desired_property",
+    "customer_name", "phone", "current_address", "email",
+    "first_call", "call_status", "mail_status", "sms_status",
+    "showing_status", "pre_assessment", "visit_status",
+    "postal_status", "billing_exclusion", "expected_rent", "memo",
+)
+# 画面側の別名を持つ列（先に値が入っているキーを使う）
+_CUSTOMER_ALIASED_FIELDS = (
+    ("mediation_status", ("mediation", "mediation_status")),
+    ("contract_status", ("contract", "contract_status")),
+    ("expected_yield", ("yield_rate", "expected_yield")),
+    ("self_funds", ("own_funds", "self_funds")),
+    ("desired_loan", ("loan_amount", "desired_loan")),
+    ("preferred_area", ("desired_area", "preferred_area")),
+)
+
+
+def customer_to_db_params(category, year, customer, now_iso=None):
+    """JSON形式の顧客データをDBパラメータに変換（now_iso は作成・更新日時が無い場合の既定値）"""
+    now_iso = now_iso or datetime.now().isoformat()
+    get = customer.get
+    params = {col: get(col) or None for col in _CUSTOMER_PLAIN_FIELDS}
+    for col, keys in _CUSTOMER_ALIASED_FIELDS:
+        value = None
+        for key in keys:
+            value = get(key)
+            if value:
+                break
+        params[col] = value or None
+    params.update(
+        id=get("id"),
+        category=category,
+        year=year,
+        case_number=get("case_number") or "",
+        inquiry_date=parse_date(get("inquiry_date")),
+        exclusion_data=dump_json(get("exclusion_data") or {}),
+        created_at=get("created_at") or now_iso,
+        updated_at=get("updated_at") or now_iso,
+    )
+    return params
+
+
+CUSTOMER_WRITE_COLUMNS = (
+    "id", "category", "year", "case_number", "status", "staff_id",
+    "inquiry_date", "inquiry_source", "contact_method",
+    "property_type", "target_property", "assessment_address", "desired_property",
+    "customer_name", "phone", "current_address", "email",
+    "first_call", "call_status", "mail_status", "sms_status",
+    "showing_status", "pre_assessment", "visit_status",
+    "mediation_status", "contract_status", "postal_status", "billing_exclusion", "exclusion_data",
+    "expected_yield", "expected_rent", "self_funds", "desired_loan", "preferred_area",
+    "memo", "created_at", "updated_at",
+)
+_CUSTOMER_UPSERT_SQL = (
+    f"INSERT INTO customers ({', '.join(CUSTOMER_WRITE_COLUMNS)}) VALUES %s"
+    " ON CONFLICT (id) DO UPDATE SET "
+    + ", ".join(
+        f"{col} = EXCLUDED.{col}" for col in CUSTOMER_WRITE_COLUMNS if col not in ("id", "created_at")
+    )
+)
+_CUSTOMER_VALUES_TEMPLATE = "(" + ", ".join(
+    "%(id)s::uuid" if col == "id" else f"%({col})s" for col in CUSTOMER_WRITE_COLUMNS
+) + ")"
+_CUSTOMER_UPSERT_ONE_SQL = _CUSTOMER_UPSERT_SQL.replace("VALUES %s", "VALUES " + _CUSTOMER_VALUES_TEMPLATE)
+
+
+# 顧客の年度一覧はプロセス内にキャッシュし、顧客を書き込んだら捨てる
+# （DB を直接編集した場合に備えて CUSTOMER_YEARS_CACHE_TTL_SECONDS で期限切れにする）
+_customer_years_cache = None
+
+
+# CSV 出力で列名が画面側のキーと異なるもの
+_CUSTOMER_EXPORT_ALIASES = {keys[0]: column for column, keys in _CUSTOMER_ALIASED_FIELDS}
+
+
+def _customer_export_column(field):
+    column = _CUSTOMER_EXPORT_ALIASES.get(field, field)
+    if column == "inquiry_date":
+        return "customers.inquiry_date::text"
+    # 空文字は NULL にそろえ、csv.writer と同じく引用符なしの空欄で出力させる
+    return f"NULLIF(customers.{column}, '')"
+
+
+def copy_customers_csv(category, year, fields, out):
+    """顧客を案件番号の降順で CSV 行（見出しなし）として out に書き出し、件数を返す
+
+    行の整形は COPY で Postgres 側に任せるため、Python では1行ごとのオブジェクトを作らない。
+    out はバイナリのファイルオブジェクト（UTF-8 のバイト列を書き込む）。
+    """
+    columns = ", ".join(_customer_export_column(field) for field in fields)
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            query = cur.mogrify(
+                f"SELECT {columns} FROM customers WHERE category = %s AND year = %s"
+                " ORDER BY customers.case_number DESC",
+                (category, year)
             )
+            cur.copy_expert(b"COPY (" + query + b") TO STDOUT WITH (FORMAT csv)", out)
+            return cur.rowcount
+
+
+def invalidate_customer_years_cache():
+    global _customer_years_cache
+    _customer_years_cache = None
+
+
+def load_customer_years():
+    """顧客データがある年度を降順のタプルで返す"""
+    global _customer_years_cache
+    cached = _customer_years_cache
+    if cached is not None and cached[0] > time.monotonic():
+        return cached[1]
+    with get_db_connection() as conn:
+        with conn.cursor(cursor_factory=_TupleCursor) as cur:
+            cur.execute("SELECT year FROM customers GROUP BY year ORDER BY year DESC")
+            years = tuple(row[0] for row in cur.fetchall())
+    _customer_years_cache = (time.monotonic() + CUSTOMER_YEARS_CACHE_TTL_SECONDS, years)
+    return years
+
+
+def save_customers_bulk(category, year, customers):
+    """複数の顧客をまとめて保存（upsert、500件ごとに1往復）"""
+    now_iso = datetime.now().isoformat()
+    rows = [customer_to_db_params(category, year, customer, now_iso) for customer in customers]
+    if not rows:
+        return
+    invalidate_customer_years_cache()
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            execute_values(cur, _CUSTOMER_UPSERT_SQL, rows, template=_CUSTOMER_VALUES_TEMPLATE, page_size=500)
+        conn.commit()
+
+
+def save_customer(category, year, customer):
+    """顧客を保存（upsert）"""
+    params = customer_to_db_params(category, year, customer)
+    invalidate_customer_years_cache()
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(_CUSTOMER_UPSERT_ONE_SQL, params)
         conn.commit()
 
 
-def delete_customer(customer_id):
-    """顧客を削除"""
+def delete_customer(category, year, customer_id):
+    """顧客を削除し、削除できたかを返す（カテゴリ・年が違う顧客は削除しない）"""
+    invalidate_customer_years_cache()
     with get_db_connection() as conn:
         with conn.cursor() as cur:
-            cur.execute("DELETE FROM customers WHERE id = %s::uuid", (customer_id,))
+            cur.execute(
+                "DELETE FROM customers WHERE id = %s::uuid AND category = %s AND year = %s",
+                (customer_id, category, year)
+            )
+            deleted = cur.rowcount
         conn.commit()
+    return deleted > 0
 
 
 def get_customer_by_id(category, year, customer_id):
@@ -861,7 +1518,7 @@ def get_customer_by_id(category, year, customer_id):
     with get_db_connection() as conn:
         with conn.cursor() as cur:
             cur.execute(
-                "SELECT * FROM customers WHERE id = %s::uuid AND category = %s AND year = %s",
+                f"{_CUSTOMER_SELECT} WHERE id = %s::uuid AND category = %s AND year = %s",
                 (customer_id, category, year)
             )
             row = cur.fetchone()
@@ -870,65 +1527,73 @@ def get_customer_by_id(category, year, customer_id):
             return db_row_to_customer(row)
 
 
-def generate_case_number_for_date(category, year, inquiry_date, existing_customers):
-    """反響日ベースで案件番号を採番"""
+def generate_case_number_for_date(category, year, inquiry_date):
+    """反響日ベースで案件番号を採番（その日までの反響件数 + 1）"""
     prefix = {"sell": "S", "buy": "B", "investment": "R"}.get(category, "X")
     year_short = str(year)[-2:] if year >= 2000 else str(year)
 
-    sorted_customers = sorted(
-        [c for c in existing_customers if c.get("inquiry_date")],
-        key=lambda c: c.get("inquiry_date") or ""
-    )
-
-    seq = 1
-    for c in sorted_customers:
-        c_date = c.get("inquiry_date") or ""
-        if c_date <= inquiry_date:
-            seq += 1
-        else:
-            break
+    # 日付として読めない反響日は、反響日のある全件より後として数える
+    target_date = parse_date(inquiry_date)
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                SELECT COUNT(*) + 1 AS seq FROM customers
+                WHERE category = %s AND year = %s AND inquiry_date IS NOT NULL
+                  AND (%s::date IS NULL OR inquiry_date <= %s::date)
+                """,
+                (category, year, target_date, target_date)
+            )
+            seq = cur.fetchone()["seq"]
 
     return f"{prefix}{year_short}{seq:04d}"
 
 
-def reassign_case_numbers(category, year):
-    """指定カテゴリ・年の全顧客の案件番号を反響日順に再採番"""
-    data = load_customers(category, year)
-    customers = data.get("customers", [])
+# 反響日順（未設定は最後）、同じ日は元の連番・案件番号・作成日時の順に番号を振り直す。
+# 文字列は Python の比較と同じ順になるよう COLLATE "C" で並べる。
+_REASSIGN_CASE_NUMBERS_SQL = """
+    WITH numbered AS (
+        SELECT id, row_number() OVER (
+            ORDER BY COALESCE(inquiry_date::text, '9999-99-99') COLLATE "C",
+                     COALESCE(substring(case_number from '[0-9]{4}$')::int, 9999),
+                     COALESCE(case_number, '') COLLATE "C",
+                     created_at NULLS FIRST,
+                     id
+        ) AS seq
+        FROM customers
+        WHERE category = %(category)s AND year = %(year)s
+    )
+    UPDATE customers
+    SET case_number = %(prefix)s || lpad(numbered.seq::text, GREATEST(4, length(numbered.seq::text)), '0')
+    FROM numbered
+    WHERE customers.id = numbered.id
+"""
 
-    if not customers:
-        return 0
 
+def reassign_case_numbers(category, year):
+    """指定カテゴリ・年の全顧客の案件番号を反響日順に再採番（並べ替えと更新は DB 側で1文）"""
     prefix = {"sell": "S", "buy": "B", "investment": "R"}.get(category, "X")
     year_short = str(year)[-2:] if year >= 2000 else str(year)
 
-    def case_seq(value):
-        if not value:
-            return 9999
-        match = re.search(r"(\d{4})$", str(value))
-        return int(match.group(1)) if match else 9999
-
-    sorted_customers = sorted(
-        customers,
-        key=lambda c: (c.get("inquiry_date") or "9999-99-99", case_seq(c.get("case_number")), c.get("case_number") or "", c.get("created_at") or "")
-    )
-
     with get_db_connection() as conn:
         with conn.cursor() as cur:
-            for idx, customer in enumerate(sorted_customers, 1):
-                new_case_number = f"{prefix}{year_short}{idx:04d}"
-                cur.execute(
-                    "UPDATE customers SET case_number = %s WHERE id = %s::uuid",
-                    (new_case_number, customer["id"])
-                )
+            cur.execute(_REASSIGN_CASE_NUMBERS_SQL, {
+                "category": category,
+                "year": year,
+                "prefix": f"{prefix}{year_short}",
+            })
+            updated = cur.rowcount
         conn.commit()
 
-    return len(sorted_customers)
+    return updated
 
 
 # ------------------------------------------------------------
 # record_locks テーブル操作
 # ------------------------------------------------------------
+_last_lock_cleanup = 0.0
+
+
 def cleanup_expired_locks():
     """期限切れのロックを削除"""
     with get_db_connection() as conn:
@@ -937,50 +1602,85 @@ def cleanup_expired_locks():
         conn.commit()
 
 
+def cleanup_expired_locks_if_due():
+    """前回の掃除から LOCK_CLEANUP_INTERVAL_SECONDS 以上経っていれば期限切れのロックを削除
+
+    期限切れのロックは読み取り側で無視するので、毎回消す必要はない。
+    """
+    global _last_lock_cleanup
+    now = time.monotonic()
+    if now - _last_lock_cleanup < LOCK_CLEANUP_INTERVAL_SECONDS:
+        return
+    _last_lock_cleanup = now
+    cleanup_expired_locks()
+
+
 def check_lock_available(resource_type, resource_id, user):
     """ロックを取得"""
-    cleanup_expired_locks()
-    now = datetime.utcnow()
+    cleanup_expired_locks_if_due()
+    now = datetime.now(timezone.utc)
     expires_at = now + timedelta(minutes=LOCK_DURATION_MINUTES)
 
+    params = {
+        "resource_type": resource_type,
+        "resource_id": resource_id,
+        "user": user,
+        "locked_at": now,
+        "expires_at": expires_at,
+    }
     with get_db_connection() as conn:
         with conn.cursor() as cur:
-            # 既存のロックをチェック
-            cur.execute(
-                "SELECT * FROM record_locks WHERE resource_type = %s AND resource_id = %s",
-                (resource_type, resource_id)
-            )
-            existing = cur.fetchone()
-
-            if existing:
-                return False, {
-                    "user": existing["locked_by"],
-                    "locked_at": format_datetime(existing["locked_at"]),
-                    "expires_at": format_datetime(existing["expires_at"]),
-                }
-
-            # 新しいロックを作成
+            # 有効なロックが無いときだけ作成する（確認と作成を1文で行う）
             try:
                 cur.execute(
                     """
                     INSERT INTO record_locks (resource_type, resource_id, locked_by, locked_at, expires_at)
-                    VALUES (%s, %s, %s, %s, %s)
+                    SELECT %(resource_type)s, %(resource_id)s, %(user)s, %(locked_at)s, %(expires_at)s
+                    WHERE NOT EXISTS (
+                        SELECT 1 FROM record_locks
+                        WHERE resource_type = %(resource_type)s AND resource_id = %(resource_id)s
+                          AND expires_at >= NOW()
+                    )
+                    RETURNING id
                     """,
-                    (resource_type, resource_id, user, now, expires_at)
+                    params
                 )
+                created = cur.fetchone()
                 conn.commit()
+            except psycopg2.IntegrityError:
+                conn.rollback()
+                return False, {"user": "unknown", "expires_at": ""}
+
+            if created:
+                invalidate_locks_cache()
                 return True, {
                     "user": user,
                     "locked_at": now.isoformat(),
                     "expires_at": expires_at.isoformat(),
                 }
-            except psycopg2.IntegrityError:
-                conn.rollback()
+
+            # 取得できなかったときだけ、現在の保持者を読む
+            cur.execute(
+                """
+                SELECT locked_by, locked_at, expires_at FROM record_locks
+                WHERE resource_type = %s AND resource_id = %s AND expires_at >= NOW()
+                LIMIT 1
+                """,
+                (resource_type, resource_id)
+            )
+            existing = cur.fetchone()
+            if existing is None:
                 return False, {"user": "unknown", "expires_at": ""}
+            return False, {
+                "user": existing["locked_by"],
+                "locked_at": format_datetime(existing["locked_at"]),
+                "expires_at": format_datetime(existing["expires_at"]),
+            }
 
 
 def release_lock(resource_type, resource_id):
     """ロックを解放"""
+    invalidate_locks_cache()
     with get_db_connection() as conn:
         with conn.cursor() as cur:
             cur.execute(
@@ -990,14 +1690,30 @@ def release_lock(resource_type, resource_id):
         conn.commit()
 
 
+# ロック一覧は LOCKS_CACHE_TTL_SECONDS だけプロセス内にキャッシュし、
+# 取得・解放のたびに捨てる（返すリストは共有なので書き換えないこと）
+_locks_cache = None
+
+
+def invalidate_locks_cache():
+    global _locks_cache
+    _locks_cache = None
+
+
 def get_all_locks():
-    """全ロックを取得"""
-    cleanup_expired_locks()
+    """全ロックを取得（期限切れは除く）"""
+    global _locks_cache
+    cached = _locks_cache
+    if cached is not None and cached[0] > time.monotonic():
+        return cached[1]
     with get_db_connection() as conn:
         with conn.cursor() as cur:
-            cur.execute("SELECT * FROM record_locks")
+            cur.execute(
+                "SELECT resource_type, resource_id, locked_by, locked_at, expires_at"
+                " FROM record_locks WHERE expires_at >= NOW()"
+            )
             rows = cur.fetchall()
-    return [
+    locks = [
         {
             "contract_id": row["resource_id"],
             "resource_type": row["resource_type"],
@@ -1007,18 +1723,21 @@ def get_all_locks():
         }
         for row in rows
     ]
+    _locks_cache = (time.monotonic() + LOCKS_CACHE_TTL_SECONDS, locks)
+    return locks
 
 
 # ------------------------------------------------------------
 # 契約IDパース・ファイル名生成
 # ------------------------------------------------------------
+@lru_cache(maxsize=4096)
 def parse_contract_id_components(contract_id):
-    """媒介No.から(西暦, 月, 連番)のタプルを返す"""
-    parts = contract_id.split("-")
-    if len(parts) != 3:
+    """媒介No.から(西暦, 月, 連番)のタプルを返す（結果は不変なので媒介No.ごとにキャッシュ）"""
+    year_part, sep, rest = contract_id.partition("-")
+    month_part, sep2, seq_part = rest.partition("-")
+    if not sep or not sep2 or "-" in seq_part:
         return None, "format"
 
-    year_part, month_part, seq_part = parts
     try:
         if year_part.lower().startswith("r"):
             era_year = int(year_part[1:])
@@ -1064,19 +1783,13 @@ def parse_contract_id(contract_id):
 
 def get_file_for_purchase_date(date_str):
     """買取日から保存先ファイル名を決定する"""
-    try:
-        dt = datetime.strptime(date_str, "%Y-%m-%d")
-    except Exception:
-        dt = datetime.now()
+    dt = parse_date(date_str) or date.today()
     return f"{dt.year}_{dt.month:02d}.json"
 
 
 def generate_purchase_id(purchase_date_str):
     """買取用の媒介No.を自動採番する (R{和暦}-{月}-999 から降順)"""
-    try:
-        dt = datetime.strptime(purchase_date_str, "%Y-%m-%d")
-    except Exception:
-        dt = datetime.now()
+    dt = parse_date(purchase_date_str) or date.today()
 
     era_year = dt.year - 2018  # 令和換算
     month = dt.month
@@ -1111,26 +1824,25 @@ def generate_purchase_id(purchase_date_str):
 # ------------------------------------------------------------
 # 月次進捗計算
 # ------------------------------------------------------------
+# 実績のない月の進捗（共有なので書き換えないこと。orjson で直接出力できるよう dict のまま持つ）
+EMPTY_MONTH_PROGRESS = {"signed": 0, "canceled": 0, "net": 0, "staff": {}}
+
+
 def build_monthly_progress():
-    monthly = {}
+    """契約テーブルの版ごとにキャッシュした月次進捗（返す dict は共有なので書き換えないこと）"""
+    return _build_monthly_progress(contracts_fingerprint())
 
-    def ensure_month(month_key):
-        return monthly.setdefault(
-            month_key,
-            {"signed": 0, "canceled": 0, "net": 0, "staff": {}},
-        )
 
-    for contract in load_all_contracts():
+@lru_cache(maxsize=4)
+def _build_monthly_progress(fingerprint):
+    # 契約ごとには (月, 担当, 種類) の件数だけ数え、月別・担当別の dict は最後に1回で組み立てる
+    events = Counter()
+    for contract in load_all_contracts_slim():
         staff = contract.get("担当") or "未設定"
 
         signed_month = month_key_from_date(contract.get("新規媒介締結日") or contract.get("ステータス日付"))
         if signed_month:
-            entry = ensure_month(signed_month)
-            entry["signed"] += 1
-            entry["net"] += 1
-            staff_entry = entry["staff"].setdefault(staff, {"signed": 0, "canceled": 0, "net": 0})
-            staff_entry["signed"] += 1
-            staff_entry["net"] += 1
+            events[signed_month, staff, "signed"] += 1
 
         cancel_month = None
         cancel_info = contract.get("中止理由") if isinstance(contract.get("中止理由"), dict) else None
@@ -1140,20 +1852,35 @@ def build_monthly_progress():
             cancel_month = month_key_from_date(contract.get("ステータス日付"))
 
         if cancel_month:
-            entry = ensure_month(cancel_month)
-            entry["canceled"] += 1
-            entry["net"] -= 1
-            staff_entry = entry["staff"].setdefault(staff, {"signed": 0, "canceled": 0, "net": 0})
-            staff_entry["canceled"] += 1
-            staff_entry["net"] -= 1
+            events[cancel_month, staff, "canceled"] += 1
+
+    monthly = {}
+    for (month_key, staff, kind), count in events.items():
+        entry = monthly.setdefault(month_key, {"signed": 0, "canceled": 0, "net": 0, "staff": {}})
+        staff_entry = entry["staff"].setdefault(staff, {"signed": 0, "canceled": 0, "net": 0})
+        net = count if kind == "signed" else -count
+        entry[kind] += count
+        entry["net"] += net
+        staff_entry[kind] += count
+        staff_entry["net"] += net
 
-    return monthly
+    # 月キーは昇順に並べておき、呼び出し側で並べ替えずに済むようにする
+    return {month_key: monthly[month_key] for month_key in sorted(monthly)}
 
 
-def build_yearly_progress(monthly_progress, goals):
+def progress_month_keys(monthly_progress, goals):
+    """実績と月次目標の月キーを昇順・重複なしで返す（実績側は生成時に整列済み）"""
+    goal_month_keys = sorted((goals.get("monthly") or {}).keys())
+    return [month_key for month_key, _ in groupby(heapq.merge(monthly_progress, goal_month_keys))]
+
+
+def build_yearly_progress(monthly_progress, goals, year_filter=None):
+    """年別の目標・進捗を集計（year_filter を渡すとその年だけ集計する）"""
+    year_filter = str(year_filter) if year_filter else None
     yearly = {}
-    all_month_keys = set(monthly_progress.keys()) | set((goals.get("monthly") or {}).keys())
     for year_key in (goals.get("annual") or {}).keys():
+        if year_filter and str(year_key) != year_filter:
+            continue
         if year_key and "-" not in str(year_key):
             yearly.setdefault(
                 str(year_key),
@@ -1165,10 +1892,12 @@ def build_yearly_progress(monthly_progress, goals):
                 },
             )
 
-    for month_key in all_month_keys:
+    for month_key in progress_month_keys(monthly_progress, goals):
         if not month_key or "-" not in month_key:
             continue
         year = month_key.split("-", 1)[0]
+        if year_filter and year != year_filter:
+            continue
         entry = yearly.setdefault(
             year,
             {
@@ -1178,13 +1907,11 @@ def build_yearly_progress(monthly_progress, goals):
                 "progress": {"signed": 0, "canceled": 0, "net": 0, "staff": {}},
             },
         )
-        if month_key not in entry["months"]:
-            entry["months"].append(month_key)
+        # 月キーは昇順・重複なしで回るので、追加するだけで months は整列済みになる
+        entry["months"].append(month_key)
 
         month_goal = get_goal_for_month(month_key, goals)
-        month_progress = monthly_progress.get(
-            month_key, {"signed": 0, "canceled": 0, "net": 0, "staff": {}}
-        )
+        month_progress = monthly_progress.get(month_key, EMPTY_MONTH_PROGRESS)
 
         entry["monthlyTargetTotal"] += month_goal.get("storeTarget", 0)
         entry["goal"]["storeTarget"] += month_goal.get("storeTarget", 0)
@@ -1205,9 +1932,6 @@ def build_yearly_progress(monthly_progress, goals):
             staff_entry["canceled"] += staff_data.get("canceled", 0)
             staff_entry["net"] += staff_data.get("net", 0)
 
-    for info in yearly.values():
-        info["months"].sort()
-
     for year, info in yearly.items():
         annual_goal = get_goal_for_year(year, goals, fallback_to_default=False)
         if annual_goal:
@@ -1240,13 +1964,16 @@ def api_login():
         return jsonify({"error": "IDとパスワードを入力してください"}), 400
 
     user = USERS.get(user_id)
-    if user and user["password"] == password:
+    password_ok = isinstance(password, str) and user is not None and hmac.compare_digest(
+        user["password_digest"], password_digest(password)
+    )
+    if password_ok:
         session.permanent = True
         session["logged_in"] = True
         session["user_id"] = user["display_name"]
         session["login_id"] = user_id
         session["is_admin"] = user.get("is_admin", False)
-        session["login_at"] = datetime.utcnow().isoformat()
+        session["login_at"] = datetime.now(timezone.utc).isoformat()
         return jsonify({
             "ok": True,
             "user_id": user["display_name"],
@@ -1278,14 +2005,7 @@ def api_check_auth():
 @app.route("/api/users", methods=["GET"])
 @login_required
 def api_get_users():
-    users_list = []
-    for login_id, info in USERS.items():
-        users_list.append({
-            "login_id": login_id,
-            "display_name": info["display_name"],
-            "is_admin": info.get("is_admin", False)
-        })
-    return jsonify(users_list)
+    return jsonify(USERS_LIST)
 
 
 # ------------------------------------------------------------
@@ -1349,38 +2069,16 @@ def api_delete_lock(contract_id):
 # ------------------------------------------------------------
 # 契約データ API
 # ------------------------------------------------------------
-def filter_active_status(status):
-    return status not in CLOSED_STATUSES
-
-
-def sort_key_contract_id(contract):
-    contract_id = contract.get("id", "")
-    parsed, _ = parse_contract_id_components(contract_id) if contract_id else (None, None)
-    if parsed:
-        return parsed
-    return (9999, 99, 9999)
-
-
 @app.route("/api/contracts/active", methods=["GET"])
 @login_required
 def api_contracts_active():
-    result = []
-    for contract in load_all_contracts():
-        status = contract.get("取引状況")
-        if status is None or filter_active_status(status):
-            result.append(contract)
-    result.sort(key=sort_key_contract_id)
-    return jsonify(result)
+    return jsonify(load_contracts_filtered(exclude_deal_statuses=CLOSED_STATUSES, order_by_contract_id=True))
 
 
 @app.route("/api/contracts/closed", methods=["GET"])
 @login_required
 def api_contracts_closed():
-    closed = []
-    for contract in load_all_contracts():
-        if contract.get("取引状況") in CLOSED_STATUSES:
-            closed.append(contract)
-    closed.sort(key=sort_key_contract_id)
+    closed = load_contracts_filtered(deal_statuses=CLOSED_STATUSES, order_by_contract_id=True)
     return jsonify(closed)
 
 
@@ -1399,8 +2097,6 @@ def api_create_contract():
     payload = request.get_json() or {}
     if not payload.get("id"):
         return jsonify({"error": "媒介No.を入力してください"}), 400
-    if duplicate_exists(payload["id"]):
-        return jsonify({"error": "この媒介No.は既に使用されています"}), 400
 
     year_month, error = parse_contract_id(payload["id"])
     if error:
@@ -1413,9 +2109,7 @@ def api_create_contract():
     payload["更新日時"] = now_iso
     payload.setdefault("ステータス日付", payload.get("新規媒介締結日") or now_iso.split("T")[0])
 
-    try:
-        save_contract(payload, year_month, allow_update=False)
-    except psycopg2.errors.UniqueViolation:
+    if not save_contract(payload, year_month, allow_update=False):
         return jsonify({"error": "この媒介No.は既に使用されています"}), 400
     return jsonify({"ok": True, "contract": payload}), 201
 
@@ -1426,7 +2120,9 @@ def api_create_purchase():
     body = request.get_json() or {}
     contract_id = body.get("id", "") or ""
 
-    purchase_date = body.get("purchaseDate") or datetime.now().strftime("%Y-%m-%d")
+    now = datetime.now()
+    now_iso = now.isoformat()
+    purchase_date = body.get("purchaseDate") or now.strftime("%Y-%m-%d")
 
     # IDが空の場合、R{和暦}-{月}-999 から降順で自動採番
     if not contract_id:
@@ -1435,12 +2131,8 @@ def api_create_purchase():
         except ValueError as e:
             return jsonify({"error": str(e)}), 400
 
-    if duplicate_exists(contract_id):
-        return jsonify({"error": "この媒介No.は既に使用されています"}), 400
-
     source_file = get_file_for_purchase_date(purchase_date)
     year_month = source_file.replace(".json", "")
-    now_iso = datetime.now().isoformat()
 
     price = body.get("price")
     try:
@@ -1481,9 +2173,7 @@ def api_create_purchase():
         "更新日時": now_iso,
     }
 
-    try:
-        save_contract(record, year_month, allow_update=False)
-    except psycopg2.errors.UniqueViolation:
+    if not save_contract(record, year_month, allow_update=False):
         return jsonify({"error": "この媒介No.は既に使用されています"}), 400
     return jsonify({"ok": True, "contract": record}), 201
 
@@ -1493,9 +2183,19 @@ def api_create_purchase():
 def api_update_contract(contract_id):
     payload = request.get_json() or {}
     new_id = payload.get("id", contract_id)
-
-    if duplicate_exists(new_id, exclude_id=contract_id):
-        return jsonify({"error": "この媒介No.は既に使用されています"}), 400
+    # 楽観的排他: 読み込み時の更新日時を If-Match か _version で渡すと、その後に
+    # 他の人が保存していた場合は上書きせず 409 を返す（渡さなければ従来どおり上書き）
+    # 比較は DB 側で時刻として行う。"*" はどの版でもよい（指定しないのと同じ）
+    expected_version = payload.pop("_version", None)
+    if request.headers.get("If-Match"):
+        expected_version = request.headers["If-Match"].removeprefix("W/").strip('"')
+    if expected_version == "*":
+        expected_version = None
+    elif expected_version:
+        try:
+            datetime.fromisoformat(expected_version)
+        except (TypeError, ValueError):
+            return jsonify({"error": "_versionは更新日時（ISO形式）で指定してください"}), 400
 
     contract = find_contract(contract_id)
     if not contract:
@@ -1529,9 +2229,7 @@ def api_update_contract(contract_id):
             "user": user
         })
 
-    change_history = contract.get("変更履歴") or []
-    change_history.extend(changes)
-    payload["変更履歴"] = change_history
+    payload["変更履歴"] = (contract.get("変更履歴") or []) + changes
 
     payload.setdefault("作成日時", contract.get("作成日時"))
     payload["更新日時"] = now_iso
@@ -1544,11 +2242,20 @@ def api_update_contract(contract_id):
 
     payload["source_file"] = f"{year_month}.json" if year_month else contract.get("source_file", "")
 
-    # 古いIDと新しいIDが異なる場合、古いレコードを削除
+    # 古いIDと新しいIDが異なる場合、古いレコードの削除と新しいIDでの挿入を同時に行う
     if contract_id != new_id:
-        delete_contract(contract_id)
-
-    save_contract(payload, year_month)
+        result, updated_at = rename_contract(contract_id, payload, year_month, expected_updated_at=expected_version)
+        if result == "duplicate":
+            return jsonify({"error": "この媒介No.は既に使用されています"}), 400
+    else:
+        updated_at = update_contract(
+            contract, payload, year_month, expected_updated_at=expected_version, history_append=changes
+        )
+        result = "ok" if updated_at is not None else "conflict"
+    if result == "conflict":
+        return jsonify({"error": VERSION_CONFLICT_MESSAGE}), 409
+    # 次の更新で _version / If-Match にそのまま渡せるよう、DB 上の更新日時を返す
+    payload["更新日時"] = updated_at
     return jsonify({"ok": True, "contract": payload})
 
 
@@ -1585,6 +2292,15 @@ def api_unlock_contract(contract_id):
 # ------------------------------------------------------------
 # 通知 API
 # ------------------------------------------------------------
+NOTIFICATION_CANDIDATE_CONDITION = """
+    mediation_expire_date <= %s
+    OR (jsonb_typeof(change_history) = 'array' AND EXISTS (
+        SELECT 1 FROM jsonb_array_elements(change_history) AS change
+        WHERE change->>'type' IN ('status', 'price') AND COALESCE(change->>'user', '') <> %s
+    ))
+"""
+
+
 @app.route("/api/notifications", methods=["GET"])
 @login_required
 def api_notifications():
@@ -1592,43 +2308,41 @@ def api_notifications():
     today = datetime.now().date()
     notifications = []
 
-    for contract in load_all_contracts():
+    # 期限が20日以内（期限切れを含む）か、他の人のステータス・価格変更がある契約だけを読む
+    candidates = iter_contracts_filtered(
+        exclude_deal_statuses=CLOSED_STATUSES,
+        extra_conditions=[(NOTIFICATION_CANDIDATE_CONDITION, (today + timedelta(days=20), user))],
+    )
+    for contract in candidates:
         contract_id = contract.get("id", "")
         address = contract.get("物件所在地", "")
-        status = contract.get("取引状況", "")
-
-        if status in CLOSED_STATUSES:
-            continue
 
         expire_date_str = contract.get("媒介期日")
-        if expire_date_str:
-            try:
-                expire_date = datetime.strptime(expire_date_str, "%Y-%m-%d").date()
-                days_left = (expire_date - today).days
-                if 0 <= days_left <= 20:
-                    notifications.append({
-                        "id": f"deadline_{contract_id}_{today.isoformat()}",
-                        "type": "deadline",
-                        "contract_id": contract_id,
-                        "address": address,
-                        "days_left": days_left,
-                        "expire_date": expire_date_str,
-                        "date": today.isoformat(),
-                        "message": f"【期限】{contract_id} の媒介期限が{days_left}日後です" if days_left > 0 else f"【期限】{contract_id} の媒介期限は本日です"
-                    })
-                elif days_left < 0:
-                    notifications.append({
-                        "id": f"deadline_{contract_id}_{today.isoformat()}",
-                        "type": "deadline_expired",
-                        "contract_id": contract_id,
-                        "address": address,
-                        "days_left": days_left,
-                        "expire_date": expire_date_str,
-                        "date": today.isoformat(),
-                        "message": f"【期限切れ】{contract_id} の媒介期限が{abs(days_left)}日過ぎています"
-                    })
-            except ValueError:
-                pass
+        expire_date = parse_date(expire_date_str)
+        if expire_date:
+            days_left = (expire_date - today).days
+            if 0 <= days_left <= 20:
+                notifications.append({
+                    "id": f"deadline_{contract_id}_{today.isoformat()}",
+                    "type": "deadline",
+                    "contract_id": contract_id,
+                    "address": address,
+                    "days_left": days_left,
+                    "expire_date": expire_date_str,
+                    "date": today.isoformat(),
+                    "message": f"【期限】{contract_id} の媒介期限が{days_left}日後です" if days_left > 0 else f"【期限】{contract_id} の媒介期限は本日です"
+                })
+            elif days_left < 0:
+                notifications.append({
+                    "id": f"deadline_{contract_id}_{today.isoformat()}",
+                    "type": "deadline_expired",
+                    "contract_id": contract_id,
+                    "address": address,
+                    "days_left": days_left,
+                    "expire_date": expire_date_str,
+                    "date": today.isoformat(),
+                    "message": f"【期限切れ】{contract_id} の媒介期限が{abs(days_left)}日過ぎています"
+                })
 
         change_history = contract.get("変更履歴") or []
         for change in change_history:
@@ -1678,18 +2392,14 @@ def api_summary():
     include_staff = month_goal.get("includeStaff", [])
 
     summary = {}
-    for contract in load_all_contracts():
-        if contract.get("取引状況") in CLOSED_STATUSES:
-            continue
-        staff = contract.get("担当") or "未設定"
-        type_name = (contract.get("種別") or "未設定").strip()
+    for staff, type_name, count in count_open_contracts_by_staff_and_type():
+        staff = staff or "未設定"
+        type_name = (type_name or "未設定").strip()
         if type_name in ("専属専任", "専属専任媒介"):
             type_name = "専属"
-        summary.setdefault(staff, {"専属": 0, "専任": 0, "一般": 0, "total": 0})
-        if type_name not in summary[staff]:
-            summary[staff][type_name] = 0
-        summary[staff][type_name] += 1
-        summary[staff]["total"] += 1
+        counts = summary.setdefault(staff, {"専属": 0, "専任": 0, "一般": 0, "total": 0})
+        counts[type_name] = counts.get(type_name, 0) + count
+        counts["total"] += count
 
     data = []
     added_staff = set()
@@ -1734,7 +2444,7 @@ def api_goals():
     year_key = request.args.get("year")
     if year_key is not None:
         year_key = str(year_key)
-        if not re.match(r"^\d{4}$", year_key):
+        if not _YEAR_KEY_RE.match(year_key):
             year_key = None
 
     if request.method == "GET":
@@ -1768,7 +2478,7 @@ def api_goals():
     }
     if body.get("year") and not body.get("month"):
         year_key = str(body.get("year"))
-        if not re.match(r"^\d{4}$", year_key):
+        if not _YEAR_KEY_RE.match(year_key):
             return jsonify({"error": "yearはYYYY形式で指定してください"}), 400
         goals = save_goal_for_year(year_key, goal_body)
         saved_goal = get_goal_for_year(year_key, goals)
@@ -1860,7 +2570,7 @@ def api_sales():
     year_key = request.args.get("year")
     if year_key is not None:
         year_key = str(year_key)
-        if not re.match(r"^\d{4}$", year_key):
+        if not _YEAR_KEY_RE.match(year_key):
             year_key = None
 
     if request.method == "GET":
@@ -1882,7 +2592,7 @@ def api_sales():
     body = request.get_json() or {}
     if body.get("year") and not body.get("month"):
         year_key = str(body.get("year"))
-        if not re.match(r"^\d{4}$", year_key):
+        if not _YEAR_KEY_RE.match(year_key):
             return jsonify({"error": "yearはYYYY形式で指定してください"}), 400
         sales = save_sales_for_year(year_key, {"store": body.get("store"), "staff": body.get("staff")})
         saved = get_sales_for_year(year_key, sales)
@@ -1908,53 +2618,110 @@ def api_sales():
     })
 
 
+# ------------------------------------------------------------
+# レスポンス本文キャッシュ
+# ------------------------------------------------------------
+# 読み取り系 API の JSON 本文をバイト列のまま保持する。キーに元データの版
+# （ETag・テーブルの版など）を含めるので書き込み時の削除は不要で、古い版は件数上限で押し出す。
+JSON_BODY_CACHE_MAX_ENTRIES = 64
+_json_body_cache = {}
+
+
+def cached_json_response(key, build_payload):
+    """key に対応する JSON 本文をキャッシュから返す（無ければ build_payload() を1回だけエンコード）"""
+    body = _json_body_cache.get(key)
+    if body is None:
+        body = app.json.dumps(build_payload()).encode("utf-8")
+        if len(_json_body_cache) >= JSON_BODY_CACHE_MAX_ENTRIES:
+            _json_body_cache.pop(next(iter(_json_body_cache)), None)
+        _json_body_cache[key] = body
+    return Response(body, mimetype="application/json")
+
+
 # ------------------------------------------------------------
 # 進捗 API
 # ------------------------------------------------------------
+def goal_progress_etag(*parts):
+    """進捗レスポンスの元になる値から ETag を作る"""
+    return hashlib.sha1(orjson.dumps(parts, option=orjson.OPT_NON_STR_KEYS)).hexdigest()[:20]
+
+
+def not_modified(etag):
+    """If-None-Match が etag と一致すれば 304 を返す（圧縮で付く ":br" などの接尾辞は無視）"""
+    for value in request.if_none_match.as_set(include_weak=True):
+        if value.split(":", 1)[0] == etag:
+            response = Response(status=304)
+            response.set_etag(etag)
+            return response
+    return None
+
+
+def saved_goal_progress_payload(saved, goals, year_filter, month_filter):
+    """保存済みの進捗から年・月で絞り込んだレスポンスを組み立てる"""
+    monthly_response = {}
+    for month_key, rec in sorted((saved.get("monthly") or {}).items()):
+        if month_filter and month_key != month_filter:
+            continue
+        if year_filter and not month_key.startswith(f"{year_filter}-"):
+            continue
+        monthly_response[month_key] = rec
+    yearly_response = saved.get("yearly") or {}
+    if year_filter:
+        yearly_response = {year: data for year, data in yearly_response.items() if year == str(year_filter)}
+    return {
+        "currentMonth": current_month_key(),
+        "updatedAt": saved.get("updatedAt", ""),
+        "monthly": monthly_response,
+        "yearly": yearly_response,
+        "annualGoals": goals.get("annual", {}),
+        "staffOrder": STAFF_ORDER,
+    }
+
+
 @app.route("/api/goals/progress", methods=["GET"])
 @login_required
 def api_goal_progress():
     year_filter = request.args.get("year")
-    if year_filter and not re.match(r"^\d{4}$", str(year_filter)):
+    if year_filter and not _YEAR_KEY_RE.match(str(year_filter)):
         return jsonify({"error": "yearはYYYY形式で指定してください"}), 400
 
     month_filter = normalize_month_key(request.args.get("month"))
     refresh_requested = str(request.args.get("refresh") or "").lower() in ("1", "true", "yes")
 
+    load_app_settings_bulk(("goal_progress", "goals"))
     saved = load_goal_progress_data()
     if not refresh_requested and (saved.get("monthly") or {}):
-        monthly_response = {}
-        for month_key, rec in sorted((saved.get("monthly") or {}).items()):
-            if month_filter and month_key != month_filter:
-                continue
-            if year_filter and not month_key.startswith(f"{year_filter}-"):
-                continue
-            monthly_response[month_key] = rec
-        yearly_response = saved.get("yearly") or {}
-        if year_filter:
-            yearly_response = {year: data for year, data in yearly_response.items() if year == str(year_filter)}
         goals = load_goals_data()
-        return jsonify({
-            "currentMonth": current_month_key(),
-            "updatedAt": saved.get("updatedAt", ""),
-            "monthly": monthly_response,
-            "yearly": yearly_response,
-            "annualGoals": goals.get("annual", {}),
-            "staffOrder": STAFF_ORDER,
-        })
+        etag = goal_progress_etag("saved", saved.get("updatedAt", ""), goals, current_month_key())
+        cached = not_modified(etag)
+        if cached:
+            return cached
+        # 保存済みの進捗は ETag が同じなら本文も同じなので、絞り込み条件ごとにバイト列で使い回す
+        response = cached_json_response(
+            ("goal_progress", etag, year_filter, month_filter),
+            lambda: saved_goal_progress_payload(saved, goals, year_filter, month_filter),
+        )
+        response.set_etag(etag)
+        return response
 
+    # 契約・目標・当月が前回と同じなら集計し直さず 304 を返す
     goals = load_goals_data()
+    etag = goal_progress_etag("computed", contracts_fingerprint(), goals, current_month_key())
+    cached = not_modified(etag)
+    if cached:
+        return cached
     monthly_progress = build_monthly_progress()
-    all_month_keys = set(monthly_progress.keys()) | set((goals.get("monthly") or {}).keys())
+    month_keys = progress_month_keys(monthly_progress, goals)
+    # 対象外の月は組み立てない
+    if month_filter:
+        month_keys = [key for key in month_keys if key == month_filter]
+    if year_filter:
+        month_keys = [key for key in month_keys if key.startswith(f"{year_filter}-")]
 
     monthly_response = {}
-    for month_key in sorted(all_month_keys):
-        if month_filter and month_key != month_filter:
-            continue
-        if year_filter and not month_key.startswith(f"{year_filter}-"):
-            continue
+    for month_key in month_keys:
         goal = get_goal_for_month(month_key, goals)
-        progress = monthly_progress.get(month_key, {"signed": 0, "canceled": 0, "net": 0, "staff": {}})
+        progress = monthly_progress.get(month_key, EMPTY_MONTH_PROGRESS)
         try:
             actual_store = int(progress.get("net") or 0)
         except (TypeError, ValueError):
@@ -1995,9 +2762,7 @@ def api_goal_progress():
             },
         }
 
-    yearly_response = build_yearly_progress(monthly_progress, goals)
-    if year_filter:
-        yearly_response = {year: data for year, data in yearly_response.items() if year == str(year_filter)}
+    yearly_response = build_yearly_progress(monthly_progress, goals, year_filter)
 
     payload = {
         "currentMonth": current_month_key(),
@@ -2012,7 +2777,9 @@ def api_goal_progress():
         "monthly": monthly_response,
         "yearly": yearly_response,
     })
-    return jsonify(payload)
+    response = jsonify(payload)
+    response.set_etag(etag)
+    return response
 
 
 # ------------------------------------------------------------
@@ -2034,10 +2801,79 @@ def api_backup_list():
 # ------------------------------------------------------------
 # 顧客管理 API
 # ------------------------------------------------------------
+CSV_EXPORT_CHUNK_BYTES = 64 * 1024
+# COPY の出力はこのサイズまではメモリ、超えた分は一時ファイルに溜めてから返す
+CSV_EXPORT_SPOOL_MAX_BYTES = 8 * 1024 * 1024
+# カテゴリごとの CSV の見出しと、対応する顧客データのキー
+CUSTOMER_EXPORT_SPEC = {
+    "sell": (
+        ["案件番号", "ステータス", "担当者", "反響日", "反響媒体", "連絡方法",
+         "物件種別", "査定住所", "氏名", "電話番号", "現住所", "メール",
+         "電話", "メール", "SMS", "査定前", "訪問", "媒介", "契約", "課金除外", "メモ"],
+        ("case_number", "status", "staff_id",
+         "inquiry_date", "inquiry_source", "contact_method",
+         "property_type", "assessment_address", "customer_name",
+         "phone", "current_address", "email",
+         "call_status", "mail_status", "sms_status",
+         "pre_assessment", "visit_status", "mediation",
+         "contract", "billing_exclusion", "memo"),
+    ),
+    "buy": (
+        ["案件番号", "ステータス", "担当者", "反響日", "反響媒体", "連絡方法",
+         "物件種別", "反響物件", "氏名", "電話番号", "現住所", "メール",
+         "電話", "メール", "案内", "契約", "メモ"],
+        ("case_number", "status", "staff_id",
+         "inquiry_date", "inquiry_source", "contact_method",
+         "property_type", "target_property", "customer_name",
+         "phone", "current_address", "email",
+         "call_status", "mail_status", "showing_status",
+         "contract", "memo"),
+    ),
+    "investment": (
+        ["案件番号", "ステータス", "担当者", "反響日", "反響媒体", "連絡方法",
+         "物件種別", "希望物件", "氏名", "電話番号", "現住所", "メール",
+         "電話", "メール", "案内", "契約", "利回り希望", "想定家賃",
+         "自己資金", "融資希望額", "希望エリア", "メモ"],
+        ("case_number", "status", "staff_id",
+         "inquiry_date", "inquiry_source", "contact_method",
+         "property_type", "desired_property", "customer_name",
+         "phone", "current_address", "email",
+         "call_status", "mail_status", "showing_status",
+         "contract", "yield_rate", "expected_rent",
+         "own_funds", "loan_amount", "desired_area",
+         "memo"),
+    ),
+}
+
+
+def csv_rows_to_crlf(chunks):
+    """COPY の CSV（行末 LF）を csv.writer と同じ行末 CRLF にして返す
+
+    引用符の数の偶奇で引用符の外かどうかを追い、値の中の改行はそのまま残す。
+    UTF-8 では '"' と '\\n' のバイトが多バイト文字の途中に現れないので、バイト列のまま数えてよい。
+    """
+    in_quotes = False
+    for chunk in chunks:
+        lines = chunk.split(b"\n")
+        out = []
+        for line in lines[:-1]:
+            if line.count(b'"') % 2:
+                in_quotes = not in_quotes
+            out.append(line + (b"\n" if in_quotes else b"\r\n"))
+        if lines[-1].count(b'"') % 2:
+            in_quotes = not in_quotes
+        out.append(lines[-1])
+        yield b"".join(out)
+
+
 @app.route("/api/customer-masters", methods=["GET"])
 @login_required
 def api_get_customer_masters():
-    return jsonify(load_customer_masters())
+    # 保存済みなら JSON 文字列をそのまま返し、読み込み・再エンコードを省く
+    text = load_app_setting_texts(("customer_masters",))["customer_masters"]
+    if text is None:
+        return jsonify(load_customer_masters())
+    return Response(text, mimetype="application/json")
 
 
 @app.route("/api/customer-masters", methods=["PUT"])
@@ -2071,6 +2907,7 @@ def api_update_customer_masters():
 @app.route("/api/exclusion-settings", methods=["GET"])
 @login_required
 def api_get_exclusion_settings():
+    load_app_settings_bulk(EXCLUSION_SETTING_KEYS)
     return jsonify({
         "rule_definitions": load_exclusion_rule_definitions(),
         "no_contact_rules": load_no_contact_rules(),
@@ -2139,7 +2976,7 @@ def api_check_duplicates():
             "customer_name": row["customer_name"] or "",
             "phone": row["phone"] or "",
             "assessment_address": row["assessment_address"] or "",
-            "inquiry_date": format_date(row["inquiry_date"]),
+            "inquiry_date": row["inquiry_date"] or "",
             "inquiry_source": row["inquiry_source"] or "",
         })
 
@@ -2163,10 +3000,7 @@ def api_check_duplicates():
         if not target_name and not target_phone and not target_address:
             continue
 
-        if isinstance(target_date, date):
-            t_date = target_date
-        else:
-            t_date = parse_date(str(target_date))
+        t_date = parse_date(target_date)
         if not t_date:
             continue
 
@@ -2220,21 +3054,12 @@ def api_check_duplicates():
 @app.route("/api/customers/years", methods=["GET"])
 @login_required
 def api_customer_years():
-    years = set()
     current_year = datetime.now().year
-    years.add(current_year)
-    for i in range(3):
-        years.add(current_year - i)
-
-    # DBから年度を取得
-    with get_db_connection() as conn:
-        with conn.cursor() as cur:
-            cur.execute("SELECT DISTINCT year FROM customers ORDER BY year DESC")
-            rows = cur.fetchall()
-            for row in rows:
-                years.add(row["year"])
-
-    return jsonify(sorted(years, reverse=True))
+    customer_years = load_customer_years()
+    return cached_json_response(
+        ("customer_years", current_year, customer_years),
+        lambda: sorted({current_year, current_year - 1, current_year - 2, *customer_years}, reverse=True),
+    )
 
 
 @app.route("/api/customers/<category>/<int:year>", methods=["GET"])
@@ -2243,46 +3068,17 @@ def api_get_customers(category, year):
     if category not in ("sell", "buy", "investment"):
         return jsonify({"error": "無効なカテゴリです"}), 400
 
-    data = load_customers(category, year)
-    customers = data.get("customers", [])
-
-    # フィルター処理
-    staff = request.args.get("staff")
-    status = request.args.get("status")
-    keyword = request.args.get("keyword")
-    date_from = request.args.get("date_from")
-    date_to = request.args.get("date_to")
-
-    if staff:
-        customers = [c for c in customers if c.get("staff_id") == staff]
-    if status:
-        customers = [c for c in customers if c.get("status") == status]
-    if keyword:
-        kw = keyword.lower()
-        customers = [c for c in customers if
-            kw in (c.get("customer_name") or "").lower() or
-            kw in (c.get("assessment_address") or "").lower() or
-            kw in (c.get("target_property") or "").lower() or
-            kw in (c.get("desired_property") or "").lower() or
-            kw in (c.get("current_address") or "").lower() or
-            kw in (c.get("case_number") or "").lower() or
-            kw in (c.get("phone") or "").lower()
-        ]
-    if date_from:
-        customers = [c for c in customers if (c.get("inquiry_date") or "") >= date_from]
-    if date_to:
-        customers = [c for c in customers if (c.get("inquiry_date") or "") <= date_to]
-
-    def case_sort_key(c):
-        cn = c.get("case_number") or ""
-        m = re.search(r"(\d{4})$", cn)
-        seq = int(m.group(1)) if m else 0
-        return (seq, cn)
-
-    customers.sort(key=case_sort_key, reverse=True)
+    customers = query_customers(
+        category, year,
+        staff=request.args.get("staff"),
+        status=request.args.get("status"),
+        keyword=request.args.get("keyword"),
+        date_from=request.args.get("date_from"),
+        date_to=request.args.get("date_to"),
+    )
 
     return jsonify({
-        "meta": data.get("meta", {}),
+        "meta": {"category": category, "year": year},
         "customers": customers,
         "total": len(customers)
     })
@@ -2301,6 +3097,25 @@ def api_get_customer(category, year, customer_id):
     return jsonify(customer)
 
 
+# 新規登録時にカテゴリごとに追加する項目と既定値（None は送られた値をそのまま使う）
+CUSTOMER_CREATE_FIELDS = {
+    "sell": (
+        ("assessment_address", ""), ("call_status", "未"), ("mail_status", "未"), ("sms_status", "未"),
+        ("pre_assessment", "未"), ("visit_status", "未"), ("mediation", "未"), ("contract", "未"),
+    ),
+    "buy": (
+        ("target_property", ""), ("call_status", "未"), ("mail_status", "未"),
+        ("showing_status", "未"), ("contract", "未"),
+    ),
+    "investment": (
+        ("desired_property", ""), ("call_status", "未"), ("mail_status", "未"),
+        ("showing_status", "未"), ("contract", "未"),
+        ("yield_rate", None), ("expected_rent", None), ("own_funds", None), ("loan_amount", None),
+        ("desired_area", ""),
+    ),
+}
+
+
 @app.route("/api/customers/<category>/<int:year>", methods=["POST"])
 @login_required
 def api_create_customer(category, year):
@@ -2314,13 +3129,10 @@ def api_create_customer(category, year):
         if not payload.get(field):
             return jsonify({"error": f"{field}は必須です"}), 400
 
-    import uuid
     now_iso = datetime.now().isoformat()
 
-    data = load_customers(category, year)
-    existing_customers = data.get("customers", [])
     inquiry_date = payload.get("inquiry_date")
-    case_number = payload.get("case_number") or generate_case_number_for_date(category, year, inquiry_date, existing_customers)
+    case_number = payload.get("case_number") or generate_case_number_for_date(category, year, inquiry_date)
 
     customer = {
         "id": str(uuid.uuid4()),
@@ -2342,32 +3154,9 @@ def api_create_customer(category, year):
         "updated_at": now_iso
     }
 
-    if category == "sell":
-        customer["assessment_address"] = payload.get("assessment_address") or ""
-        customer["call_status"] = payload.get("call_status") or "未"
-        customer["mail_status"] = payload.get("mail_status") or "未"
-        customer["sms_status"] = payload.get("sms_status") or "未"
-        customer["pre_assessment"] = payload.get("pre_assessment") or "未"
-        customer["visit_status"] = payload.get("visit_status") or "未"
-        customer["mediation"] = payload.get("mediation") or "未"
-        customer["contract"] = payload.get("contract") or "未"
-    elif category == "buy":
-        customer["target_property"] = payload.get("target_property") or ""
-        customer["call_status"] = payload.get("call_status") or "未"
-        customer["mail_status"] = payload.get("mail_status") or "未"
-        customer["showing_status"] = payload.get("showing_status") or "未"
-        customer["contract"] = payload.get("contract") or "未"
-    elif category == "investment":
-        customer["desired_property"] = payload.get("desired_property") or ""
-        customer["call_status"] = payload.get("call_status") or "未"
-        customer["mail_status"] = payload.get("mail_status") or "未"
-        customer["showing_status"] = payload.get("showing_status") or "未"
-        customer["contract"] = payload.get("contract") or "未"
-        customer["yield_rate"] = payload.get("yield_rate")
-        customer["expected_rent"] = payload.get("expected_rent")
-        customer["own_funds"] = payload.get("own_funds")
-        customer["loan_amount"] = payload.get("loan_amount")
-        customer["desired_area"] = payload.get("desired_area") or ""
+    for key, default in CUSTOMER_CREATE_FIELDS[category]:
+        value = payload.get(key)
+        customer[key] = value if default is None else (value or default)
 
     save_customer(category, year, customer)
     return jsonify({"ok": True, "customer": customer}), 201
@@ -2400,11 +3189,8 @@ def api_delete_customer(category, year, customer_id):
     if category not in ("sell", "buy", "investment"):
         return jsonify({"error": "無効なカテゴリです"}), 400
 
-    customer = get_customer_by_id(category, year, customer_id)
-    if not customer:
+    if not delete_customer(category, year, customer_id):
         return jsonify({"error": "顧客が見つかりません"}), 404
-
-    delete_customer(customer_id)
     reassign_case_numbers(category, year)
     return jsonify({"ok": True})
 
@@ -2425,10 +3211,8 @@ def api_generate_case_number(category, year):
     if category not in ("sell", "buy", "investment"):
         return jsonify({"error": "無効なカテゴリです"}), 400
 
-    data = load_customers(category, year)
-    existing_customers = data.get("customers", [])
     inquiry_date = datetime.now().strftime("%Y-%m-%d")
-    case_number = generate_case_number_for_date(category, year, inquiry_date, existing_customers)
+    case_number = generate_case_number_for_date(category, year, inquiry_date)
     return jsonify({"case_number": case_number})
 
 
@@ -2438,74 +3222,37 @@ def api_export_customers(category, year):
     if category not in ("sell", "buy", "investment"):
         return jsonify({"error": "無効なカテゴリです"}), 400
 
-    data = load_customers(category, year)
-    customers = data.get("customers", [])
-
-    if not customers:
+    headers, fields = CUSTOMER_EXPORT_SPEC[category]
+    # 本文は COPY で一括して受け取り、接続はレスポンスの送信を待たずにプールへ返す
+    spool = tempfile.SpooledTemporaryFile(max_size=CSV_EXPORT_SPOOL_MAX_BYTES)
+    try:
+        copied = copy_customers_csv(category, year, fields, spool)
+    except Exception:
+        spool.close()
+        raise
+    if not copied:
+        spool.close()
         return jsonify({"error": "データがありません"}), 404
+    spool.seek(0)
 
-    output = io.StringIO()
+    header = io.StringIO()
+    csv.writer(header).writerow(headers)
 
-    if category == "sell":
-        headers = ["案件番号", "ステータス", "担当者", "反響日", "反響媒体", "連絡方法",
-                   "物件種別", "査定住所", "氏名", "電話番号", "現住所", "メール",
-                   "電話", "メール", "SMS", "査定前", "訪問", "媒介", "契約", "課金除外", "メモ"]
-    elif category == "buy":
-        headers = ["案件番号", "ステータス", "担当者", "反響日", "反響媒体", "連絡方法",
-                   "物件種別", "反響物件", "氏名", "電話番号", "現住所", "メール",
-                   "電話", "メール", "案内", "契約", "メモ"]
-    else:
-        headers = ["案件番号", "ステータス", "担当者", "反響日", "反響媒体", "連絡方法",
-                   "物件種別", "希望物件", "氏名", "電話番号", "現住所", "メール",
-                   "電話", "メール", "案内", "契約", "利回り希望", "想定家賃",
-                   "自己資金", "融資希望額", "希望エリア", "メモ"]
-
-    writer = csv.writer(output)
-    writer.writerow(headers)
-
-    for c in customers:
-        if category == "sell":
-            row = [
-                c.get("case_number"), c.get("status"), c.get("staff_id"),
-                c.get("inquiry_date"), c.get("inquiry_source"), c.get("contact_method"),
-                c.get("property_type"), c.get("assessment_address"), c.get("customer_name"),
-                c.get("phone"), c.get("current_address"), c.get("email"),
-                c.get("call_status"), c.get("mail_status"), c.get("sms_status"),
-                c.get("pre_assessment"), c.get("visit_status"), c.get("mediation"),
-                c.get("contract"), c.get("billing_exclusion"), c.get("memo")
-            ]
-        elif category == "buy":
-            row = [
-                c.get("case_number"), c.get("status"), c.get("staff_id"),
-                c.get("inquiry_date"), c.get("inquiry_source"), c.get("contact_method"),
-                c.get("property_type"), c.get("target_property"), c.get("customer_name"),
-                c.get("phone"), c.get("current_address"), c.get("email"),
-                c.get("call_status"), c.get("mail_status"), c.get("showing_status"),
-                c.get("contract"), c.get("memo")
-            ]
-        else:
-            row = [
-                c.get("case_number"), c.get("status"), c.get("staff_id"),
-                c.get("inquiry_date"), c.get("inquiry_source"), c.get("contact_method"),
-                c.get("property_type"), c.get("desired_property"), c.get("customer_name"),
-                c.get("phone"), c.get("current_address"), c.get("email"),
-                c.get("call_status"), c.get("mail_status"), c.get("showing_status"),
-                c.get("contract"), c.get("yield_rate"), c.get("expected_rent"),
-                c.get("own_funds"), c.get("loan_amount"), c.get("desired_area"),
-                c.get("memo")
-            ]
-        writer.writerow(row)
-
-    output.seek(0)
+    def generate():
+        yield header.getvalue().encode("utf-8")
+        yield from csv_rows_to_crlf(iter(lambda: spool.read(CSV_EXPORT_CHUNK_BYTES), b""))
 
     category_names = {"sell": "売り", "buy": "買い", "investment": "収益"}
     filename = f"customers_{category_names[category]}_{year}.csv"
 
-    return Response(
-        output.getvalue(),
+    response = Response(
+        generate(),
         mimetype="text/csv",
         headers={"Content-Disposition": f"attachment; filename={filename}"}
     )
+    # 本文を読まずに終わった場合（HEAD や途中切断）も一時ファイルを閉じる
+    response.call_on_close(spool.close)
+    return response
 
 
 # ------------------------------------------------------------
@@ -2539,11 +3286,16 @@ def serve_manifest():
 @app.route("/", defaults={"path": ""})
 @app.route("/<path:path>")
 def serve_index(path):
-    if path and os.path.exists(os.path.join(app.static_folder, path)):
-        response = send_from_directory(app.static_folder, path)
-        if path in ("index.html", "sw.js", "manifest.json") or path.endswith((".js", ".css")):
-            return set_no_store_headers(response)
-        return response
+    # 存在確認を別にせず send_from_directory に任せ、無ければ SPA の index.html を返す
+    if path:
+        try:
+            response = send_from_directory(app.static_folder, path)
+        except NotFound:
+            pass
+        else:
+            if path in ("index.html", "sw.js", "manifest.json") or path.endswith((".js", ".css")):
+                return set_no_store_headers(response)
+            return response
     response = send_from_directory(app.static_folder, "index.html")
     return set_no_store_headers(response)
 